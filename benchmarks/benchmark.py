@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks the evaluation code on synthetic images and Inception codes.
+
+Each benchmark is timed and its throughput and peak memory usage are measured. If a baseline
+exists, results are compared against it and the script fails if a benchmark became slower or needs
+more memory than allowed by `--threshold`, or if its results changed.
+"""
+
+import os
+import sys
+import json
+import logging
+import time
+import tracemalloc
+import numpy as np
+from argparse import ArgumentParser
+from functools import partial
+from shutil import rmtree
+from tempfile import mkdtemp
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+import metrics
+import mmd
+from msssim import MultiScaleSSIM, MultiScaleSSIMFast
+
+
+def main(args):
+	baseline = None
+	if os.path.exists(args.baseline):
+		with open(args.baseline) as handle:
+			baseline = json.load(handle)
+		if baseline['config'] != config(args):
+			print('Baseline was created with different arguments, ignoring it\n')
+			baseline = None
+
+	data_dir = mkdtemp()
+	results = {}
+	failures = []
+
+	try:
+		print('{:<24} {:>10} {:>10} {:>12}'.format('Benchmark', 'Time (s)', 'MP/s', 'Memory (MB)'))
+
+		for name, func, megapixels in benchmarks(args, data_dir):
+			if args.only and not any(pattern in name for pattern in args.only):
+				continue
+
+			result = run_benchmark(func, megapixels, args.repeat)
+			results[name] = result
+
+			print('{:<24} {:>10.3f} {:>10} {:>12.1f}'.format(
+				name,
+				result['seconds'],
+				'{:.2f}'.format(result['megapixels_per_second']) if megapixels else '-',
+				result['peak_memory'] / 1e6), end='')
+
+			if baseline and name in baseline['results']:
+				messages = compare(result, baseline['results'][name], args.threshold)
+				failures.extend(f'{name}: {message}' for message in messages)
+				print('  ' + ('; '.join(messages) if messages else 'OK'))
+			else:
+				print()
+
+	finally:
+		rmtree(data_dir)
+
+	if args.save_baseline:
+		with open(args.baseline, 'w') as handle:
+			json.dump({'config': config(args), 'results': results}, handle, indent=2)
+		print(f'\nStored baseline in {args.baseline}')
+		return 0
+
+	if failures:
+		print('\nRegressions:')
+		for failure in failures:
+			print(f'  {failure}')
+		return 1
+
+	return 0
+
+
+def config(args):
+	"""
+	Arguments which affect the results of benchmarks.
+	"""
+
+	return {
+		'sizes': args.sizes,
+		'num_images': args.num_images,
+		'num_codes': args.num_codes,
+		'settings': args.settings,
+		'seed': args.seed,
+	}
+
+
+def benchmarks(args, data_dir):
+	"""
+	Generates benchmarks.
+
+	Returns
+	-------
+	generator
+		Yields the name of a benchmark, a function to time and the number of megapixels it processes
+	"""
+
+	rs = np.random.RandomState(args.seed)
+
+	for size in args.sizes:
+		width, height = map(int, size.split('x'))
+		targets, reconstructions = synthetic_images(args.num_images, height, width, rs)
+		megapixels = args.num_images * height * width / 1e6
+
+		# data is bound to the functions, so that benchmarks can also be run after collecting them
+		yield f'mse/{size}', partial(mse_benchmark, targets, reconstructions), megapixels
+		yield f'msssim/{size}', partial(
+			msssim_benchmark, MultiScaleSSIM, targets, reconstructions), megapixels
+		yield f'msssim_fast/{size}', partial(
+			msssim_benchmark, MultiScaleSSIMFast, targets, reconstructions), megapixels
+
+		# images are evaluated end to end from PNG files
+		target_files, submission_files = {}, {}
+		for k, (image0, image1) in enumerate(zip(targets, reconstructions)):
+			name = f'{size}_{k}.png'
+			target_files[name] = os.path.join(data_dir, size, 'target', name)
+			submission_files[name] = os.path.join(data_dir, size, 'submission', name)
+			os.makedirs(os.path.dirname(target_files[name]), exist_ok=True)
+			os.makedirs(os.path.dirname(submission_files[name]), exist_ok=True)
+			Image.fromarray(image0).save(target_files[name])
+			Image.fromarray(image1).save(submission_files[name])
+
+		settings = dict(json.loads(args.settings), metrics=['PSNR', 'MSSSIM'])
+		logger = logging.getLogger('benchmark')
+
+		yield f'evaluate/{size}', partial(
+			evaluate_benchmark, submission_files, target_files, settings, logger), megapixels
+
+	# Inception codes of targets and of reconstructions
+	codes0 = rs.randn(args.num_codes, 2048).astype(np.float32)
+	codes1 = codes0 + rs.randn(args.num_codes, 2048).astype(np.float32) / 2.
+	num_codes = f'{args.num_codes}x2048'
+
+	def fid():
+		# same parameters as used by metrics.fid, which samples bootstrap splits
+		np.random.seed(args.seed)
+		with open(os.devnull, 'w') as devnull:
+			return float(np.mean(mmd.fid_score(
+				codes0, codes1, splits=10, split_method='bootstrap', output=devnull)))
+
+	def kid():
+		# same parameters as used by metrics.kid, which samples subsets
+		np.random.seed(args.seed)
+		with open(os.devnull, 'w') as devnull:
+			return float(np.mean(mmd.polynomial_mmd_averages(
+				codes1, codes0,
+				n_subsets=100,
+				subset_size=min(1000, args.num_codes),
+				ret_var=False,
+				output=devnull)))
+
+	yield f'fid/{num_codes}', fid, 0
+	yield f'kid/{num_codes}', kid, 0
+
+
+def mse_benchmark(targets, reconstructions):
+	return float(sum(metrics.mse(image0, image1) for image0, image1 in zip(targets, reconstructions)))
+
+
+def msssim_benchmark(msssim, targets, reconstructions):
+	return float(np.mean([
+		msssim(image0[None], image1[None]) for image0, image1 in zip(targets, reconstructions)]))
+
+
+def evaluate_benchmark(submission_files, target_files, settings, logger):
+	return {
+		metric: float(value) for metric, value in metrics.evaluate(
+			submission_files, target_files, settings, logger).items()}
+
+
+def synthetic_images(num_images, height, width, rs):
+	"""
+	Generates smooth 8-bit images and noisy reconstructions of them.
+	"""
+
+	targets = []
+	reconstructions = []
+
+	for _ in range(num_images):
+		coarse = rs.randint(256, size=(max(1, height // 16), max(1, width // 16), 3)).astype(np.uint8)
+		image = np.asarray(Image.fromarray(coarse).resize((width, height), Image.BICUBIC))
+		noise = rs.randn(height, width, 3) * 4.
+		targets.append(image)
+		reconstructions.append(np.clip(image + noise, 0, 255).astype(np.uint8))
+
+	return targets, reconstructions
+
+
+def run_benchmark(func, megapixels, repeat):
+	"""
+	Times a function and measures the peak memory it allocates.
+
+	Memory is measured in a separate run, since tracing allocations slows down execution.
+	"""
+
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		value = func()
+		times.append(time.perf_counter() - start)
+
+	tracemalloc.start()
+	func()
+	_, peak_memory = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+
+	seconds = min(times)
+
+	return {
+		'seconds': seconds,
+		'megapixels_per_second': megapixels / seconds if megapixels else None,
+		'peak_memory': peak_memory,
+		'value': value,
+	}
+
+
+def compare(result, baseline, threshold):
+	"""
+	Compares the result of a benchmark to its baseline.
+
+	Returns
+	-------
+	list[str]
+		Descriptions of regressions
+	"""
+
+	messages = []
+
+	if result['seconds'] > baseline['seconds'] * (1. + threshold):
+		messages.append('{:.0f}% slower'.format((result['seconds'] / baseline['seconds'] - 1.) * 100.))
+	if result['peak_memory'] > baseline['peak_memory'] * (1. + threshold):
+		messages.append('{:.0f}% more memory'.format(
+			(result['peak_memory'] / baseline['peak_memory'] - 1.) * 100.))
+
+	values = result['value'] if isinstance(result['value'], dict) else {'value': result['value']}
+	baseline_values = baseline['value'] if isinstance(baseline['value'], dict) else {'value': baseline['value']}
+	for key, value in values.items():
+		if not np.isclose(value, baseline_values.get(key, np.nan), rtol=1e-5, atol=0.):
+			messages.append(f'{key} changed from {baseline_values.get(key)} to {value}')
+
+	return messages
+
+
+if __name__ == '__main__':
+	parser = ArgumentParser(description=__doc__.strip().split('\n')[0])
+	parser.add_argument('--sizes', type=str, nargs='+', default=['768x512', '2048x1536'],
+		help='Sizes of synthetic images given as WIDTHxHEIGHT')
+	parser.add_argument('--num_images', type=int, default=4,
+		help='Number of synthetic images of each size')
+	parser.add_argument('--num_codes', type=int, default=2000,
+		help='Number of Inception codes used by FID and KID')
+	parser.add_argument('--settings', type=str, default='{}',
+		help='Phase settings used by end-to-end evaluations, as JSON')
+	parser.add_argument('--only', type=str, nargs='+',
+		help='Only run benchmarks whose name contains one of these strings')
+	parser.add_argument('--repeat', type=int, default=3,
+		help='Each benchmark is timed this many times and the fastest run is reported')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--baseline', type=str,
+		default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json'),
+		help='Results are compared to this baseline')
+	parser.add_argument('--save_baseline', action='store_true',
+		help='Store results as new baseline instead of comparing them')
+	parser.add_argument('--threshold', type=float, default=0.2,
+		help='Allowed relative increase of time and memory compared to the baseline')
+
+	args = parser.parse_args()
+
+	sys.exit(main(args))
@@ -0,0 +1,49 @@
+"""
+Helpers for caching data which only depends on the targets of a phase.
+
+Each phase has its own cache directory. `evaluate.py` synchronizes it with a storage bucket, so
+that cached data is reused by all evaluations of the phase. Files whose names contain a key are only
+obtained when an evaluation needs them, and keys which an evaluation did not use are removed from
+the bucket afterwards.
+"""
+
+import hashlib
+import json
+import os
+
+
+def hash_file(file_name, chunk_size=1 << 20):
+	"""
+	Computes the SHA-224 hash of a file's content.
+	"""
+
+	sha224 = hashlib.sha224()
+	with open(file_name, 'rb') as handle:
+		for chunk in iter(lambda: handle.read(chunk_size), b''):
+			sha224.update(chunk)
+	return sha224.hexdigest()
+
+
+def cache_key(*args):
+	"""
+	Computes a key from JSON serializable arguments.
+	"""
+
+	return hashlib.sha224(json.dumps(args, sort_keys=True).encode()).hexdigest()
+
+
+def cache_path(cache_dir, prefix, key, extension='.npy', fetch=None):
+	"""
+	Returns the path of a cached file, or `None` if caching is disabled.
+
+	If the file does not exist yet and `fetch` is given, `fetch(path)` is called first, which may
+	obtain the file, for example, from a storage bucket.
+	"""
+
+	if not cache_dir:
+		return None
+	os.makedirs(cache_dir, exist_ok=True)
+	path = os.path.join(cache_dir, f'{prefix}_{key}{extension}')
+	if fetch and not os.path.exists(path):
+		fetch(path)
+	return path
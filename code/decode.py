@@ -9,58 +9,52 @@ This script executes a submission by doing the following:
 	4. Copy files generated by decoder back to the storage bucket
 """
 
+import cProfile
 import os
+import re
+import shutil
 import sys
 import time
 import traceback
 from argparse import ArgumentParser
-from subprocess import run, CalledProcessError, TimeoutExpired, PIPE, DEVNULL, STDOUT
+from docker_client import SOCKET_PATH, DockerClient, DockerError, NotFoundError
+from pipeline import DECODED_NAME, MANIFEST_NAME, UPLOADED_NAME, mark
+from prefetch import STATE_FILE, is_prefetched
+from storage import get_storage, run_concurrently
+from subprocess import run, CalledProcessError, PIPE
+from telemetry import ContainerMonitor
 from tempfile import mkdtemp
-from utils import get_logger, get_submission, sql_setup
+from uploader import OutputUploader
+from utils import Timer, get_logger, get_submission, sql_setup
 from zipfile import ZipFile
 
 EXECUTABLE_NAME = 'decode'
 ZIP_FILE_NAME = 'decoder.zip'
 
-DECODE_CMD_CPU = [
-	'docker', 'run',
-	'--network', 'none',
-	'--memory', '{memory_limit}m',
-	'--memory-swap', '{memory_limit}m',
-	'--cpus', '{num_cpus}',
-	'--name', '{identifier}',
-	'-v', '{work_dir}:/home/{identifier}',
-	'-w', '/home/{identifier}',
-	'-e', 'TF_CPP_MIN_LOG_LEVEL=3',
-	'--entrypoint', './' + EXECUTABLE_NAME,
-	'{image}']
-
-DECODE_CMD_GPU = [
-	'docker', 'run',
-	'--network', 'none',
-	'--memory', '{memory_limit}m',
-	'--memory-swap', '{memory_limit}m',
-	'--cpus', '{num_cpus}',
-	'--name', '{identifier}',
-	'-v', '{work_dir}:/home/{identifier}',
-	'-v', '/home/kubernetes/bin/nvidia:/usr/local/nvidia:ro',
-	'-v', '/home/kubernetes/bin/nvidia/vulkan/icd.d:/etc/vulkan/icd.d:ro',
-	'--device', '/dev/nvidia0:/dev/nvidia0:mrw',
-	'--device', '/dev/nvidiactl:/dev/nvidiactl:mrw',
-	'--device', '/dev/nvidia-uvm:/dev/nvidia-uvm:mrw',
-	'--device', '/dev/nvidia-uvm-tools:/dev/nvidia-uvm-tools:mrw',
-	'-w', '/home/{identifier}',
-	'-e', 'TF_CPP_MIN_LOG_LEVEL=3',
-	'--entrypoint', './' + EXECUTABLE_NAME,
-	'{image}']
-
-DECODE_CMD = {True: DECODE_CMD_GPU, False: DECODE_CMD_CPU}
-
+GPU_DEVICES = [
+	'/dev/nvidia0',
+	'/dev/nvidiactl',
+	'/dev/nvidia-uvm',
+	'/dev/nvidia-uvm-tools']
 
 def main(args):
 	log_file = os.path.join(mkdtemp(), '.log_decode')
 	logger = get_logger(debug=args.debug, filename=log_file)
 
+	# time spent in each stage of decoding
+	timer = Timer()
+	timings_file = os.path.join(os.path.dirname(log_file), '.timings_decode.json')
+
+	# resources used by the decoder
+	telemetry_file = os.path.join(os.path.dirname(log_file), '.telemetry_decode.json')
+
+	# in debug mode, decoding is additionally profiled
+	profiler = None
+	profile_file = os.path.join(os.path.dirname(log_file), '.profile_decode')
+	if args.debug:
+		profiler = cProfile.Profile()
+		profiler.enable()
+
 	try:
 		logger.debug('Connecting to SQL database')
 		sql_setup()
@@ -89,62 +83,99 @@ def main(args):
 	# directory on host in which decoder will be run
 	identifier = submission.task.name + '_' + submission.phase.name + '_' + submission.team.username
 
-	# create working directory
-	work_dir = os.path.join(args.exec_dir, identifier)
+	# connection to the Docker daemon on the host
+	docker = DockerClient(args.docker_socket)
+
+	# create working directory, which is shared with the evaluation in pipelined mode
+	work_dir = os.path.join(args.exec_dir, str(submission.id) if args.pipelined else identifier)
 	run('mkdir -p {dir}'.format(dir=work_dir), check=True, shell=True)
 
-	# ativate service account (needed for gsutil)
-	run('gcloud auth activate-service-account --quiet --key-file={key_file}'.format(
-			key_file=os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')),
-		stdout=PIPE,
-		stderr=PIPE,
-		check=False,
-		shell=True)
+	# storage buckets
+	submissions = get_storage(os.environ['BUCKET_SUBMISSIONS'])
+	environments = get_storage(os.environ['BUCKET_ENVIRONMENTS'])
 
-	# copy submission files
 	try:
-		logger.debug('Copying submission files')
-		run('gsutil -m rsync -e -R gs://{bucket}/{path}/ {work_dir}'.format(
-				bucket=os.environ['BUCKET_SUBMISSIONS'],
-				path=submission.fs_path(),
-				work_dir=work_dir),
+		# ativate service account (needed for gsutil, unless buckets are stored locally)
+		run('gcloud auth activate-service-account --quiet --key-file={key_file}'.format(
+				key_file=os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')),
 			stdout=PIPE,
 			stderr=PIPE,
-			check=True,
+			check=False,
 			shell=True)
-	except CalledProcessError as error:
-		logger.error('Failed to copy submission files')
-		logger.debug(error.stderr)
-		submission.status = Submission.STATUS_ERROR
-		submission.save()
-		return 1
 
-	# copy environment files
-	try:
-		logger.debug('Copying environment files')
-		run('gsutil -m rsync -e -R gs://{bucket}/{path}/ {work_dir}'.format(
-				bucket=os.environ['BUCKET_ENVIRONMENTS'],
-				path=os.path.join(submission.task.name, submission.phase.name),
-				work_dir=work_dir),
-			stderr=PIPE,
-			stdout=PIPE,
-			check=True,
-			shell=True)
-	except CalledProcessError as error:
-		logger.error('Failed to copy environment files')
-		logger.debug(error.stderr)
-		run('fusermount -u {}'.format(submission_dir), shell=True)
-		submission.status = Submission.STATUS_ERROR
-		submission.save()
-		return 1
+		# decoders which have been extracted before are reused instead of downloaded
+		decoder_dir = cached_decoder(args.decoder_cache, submission.decoder_hash)
+		if decoder_dir:
+			logger.debug('Found decoder in cache')
+
+		# checkpoints are only read by the evaluation, which rejects results of images which changed
+		exclude = ['\\.checkpoint_evaluate/']
+		if decoder_dir:
+			exclude.append(re.escape(ZIP_FILE_NAME) + '$')
+
+		# copy submission and environment files at the same time, environment files are copied to a
+		# separate directory first so that they take precedence over submitted files
+		logger.debug('Copying submission and environment files')
+		environment_dir = mkdtemp(dir=args.exec_dir, prefix='.environment_')
+		with timer.stage('download'):
+			transfers = run_concurrently({
+				'download_submission': lambda: submissions.download(
+					submission.fs_path(),
+					work_dir,
+					exclude='^({})'.format('|'.join(exclude))),
+				'download_environment': lambda: environments.download(
+					os.path.join(submission.task.name, submission.phase.name),
+					environment_dir),
+			})
+		for name, transfer in transfers.items():
+			timer.add(name, transfer.seconds)
+
+		try:
+			if transfers['download_submission'].error:
+				logger.error('Failed to copy submission files')
+				logger.debug(transfers['download_submission'].error)
+				submission.status = Submission.STATUS_ERROR
+				submission.save()
+				return 1
+
+			if transfers['download_environment'].error:
+				logger.error('Failed to copy environment files')
+				logger.debug(transfers['download_environment'].error)
+				submission.status = Submission.STATUS_ERROR
+				submission.save()
+				return 1
+
+			move_files(environment_dir, work_dir)
+		finally:
+			shutil.rmtree(environment_dir, ignore_errors=True)
+
+		if decoder_dir:
+			try:
+				logger.info('Copying decoder from cache')
+				with timer.stage('copy_decoder'):
+					copy_decoder(decoder_dir, work_dir)
+			except CalledProcessError as error:
+				# the cached decoder may have been evicted by another job in the meantime
+				logger.warning('Failed to copy decoder from cache')
+				logger.debug(error.stderr)
+				decoder_dir = None
+				with timer.stage('download_decoder'):
+					submissions.download_file(
+						os.path.join(submission.fs_path(), ZIP_FILE_NAME),
+						work_dir,
+						check=False)
 
-	try:
 		# unzip decoder if zipped
 		zip_path = os.path.join(work_dir, ZIP_FILE_NAME)
-		if os.path.exists(zip_path):
+		if not decoder_dir and os.path.exists(zip_path):
 			logger.info('Unzipping decoder')
 			try:
-				ZipFile(zip_path).extractall(work_dir)
+				with timer.stage('unzip'):
+					if args.decoder_cache and submission.decoder_hash:
+						decoder_dir = cache_decoder(zip_path, args.decoder_cache, submission.decoder_hash)
+						copy_decoder(decoder_dir, work_dir)
+					else:
+						ZipFile(zip_path).extractall(work_dir)
 			except UnicodeEncodeError:
 				logger.error('Unzipping failed')
 				logger.error('Filenames should only use ASCII characters')
@@ -153,10 +184,16 @@ def main(args):
 				return 1
 			except:
 				logger.error('Unzipping failed')
+				logger.debug(traceback.format_exc())
 				submission.status = Submission.STATUS_ERROR
 				submission.save()
 				return 1
 
+			if decoder_dir:
+				# keep the size of the cache below its limit
+				with timer.stage('evict_decoders'):
+					for evicted_dir in evict_decoders(args.decoder_cache, args.decoder_cache_size, keep=[decoder_dir]):
+						logger.debug('Removed decoder {} from cache'.format(os.path.basename(evicted_dir)))
 
 		# check if decoder executable is present
 		executable_path = os.path.join(work_dir, EXECUTABLE_NAME)
@@ -169,85 +206,121 @@ def main(args):
 		run('chmod +x {}'.format(executable_path), check=True, shell=True)
 
 		# make sure latest Docker image is present before decoder starts
-		try:
-			logger.info('Pulling Docker image')
-			run('docker pull {} > /dev/null'.format(submission.docker_image.name),
-				stdout=PIPE, stderr=PIPE, check=True, shell=True)
-		except CalledProcessError as error:
-			logger.warn('Failed to pull Docker image')
-			logger.debug(error.stdout)
-			logger.debug(error.stderr)
+		if is_prefetched(docker, submission.docker_image.name, args.prefetch_max_age, args.prefetch_state_file):
+			logger.info('Docker image is up to date')
+		else:
+			try:
+				logger.info('Pulling Docker image')
+				with timer.stage('docker_pull'):
+					docker.pull(submission.docker_image.name)
+			except DockerError as error:
+				logger.warn('Failed to pull Docker image')
+				logger.debug(error)
 
 		# delete container if for some reason it already exists
-		containers = run('docker ps -a --format {{.Names}}',
-			stdout=PIPE, stderr=DEVNULL, check=True, shell=True).stdout
-		if identifier in containers.decode().split():
-			logger.debug('Removing existing container')
-			run('docker stop {}'.format(identifier),
-				stdout=PIPE, stderr=PIPE, check=True, shell=True)
-			run('docker rm {}'.format(identifier),
-				stdout=PIPE, stderr=PIPE, check=True, shell=True)
+		try:
+			docker.remove(identifier, force=True)
+			logger.debug('Removed existing container')
+		except NotFoundError:
+			pass
+
+		# uploads outputs of the decoder while it is running and, in pipelined mode, lists them
+		# in a manifest read by the evaluation
+		uploader = None
+		if args.upload_interval > 0 or args.pipelined:
+			uploader = OutputUploader(
+				work_dir,
+				submissions,
+				submission.fs_path(),
+				interval=args.upload_interval or 10.,
+				manifest=os.path.join(work_dir, MANIFEST_NAME) if args.pipelined else None,
+				logger=logger)
+
+			# outputs are only detected if they are created after the uploader started
+			uploader.start()
 
 		try:
-			decode_cmd = [
-				s.format(
-					work_dir=work_dir,
+			logger.info('Starting decoder')
+			with timer.stage('docker_start'):
+				docker.create_container(identifier, container_config(
 					identifier=identifier,
+					work_dir=work_dir,
 					image=submission.docker_image.name,
 					memory_limit=submission.phase.memory,
-					num_cpus=submission.phase.cpu)
-				for s in DECODE_CMD[submission.docker_image.gpu]]
+					num_cpus=submission.phase.cpu,
+					gpu=submission.docker_image.gpu))
+				docker.start(identifier)
+		except DockerError as error:
+			submission.status = Submission.STATUS_DECODING_FAILED
+			submission.save()
+			logger.error('Unable to start Docker container')
+			logger.debug(error)
+			if uploader:
+				uploader.stop()
+			return 1
 
+		# records resources used by the decoder
+		monitor = ContainerMonitor(
+			identifier,
+			interval=args.telemetry_interval,
+			gpu=submission.docker_image.gpu,
+			socket_path=args.docker_socket)
+
+		try:
 			# run decoder
 			logger.info('Running decoder')
 			start = time.time()
 
-			run(decode_cmd, timeout=submission.phase.timeout, check=True, shell=False)
-
-			logger.info('Decoding complete')
-
-			submission.decoding_time = time.time() - start
-			submission.status = Submission.STATUS_DECODED
-			submission.save()
-
-		except CalledProcessError as error:
-			submission.status = Submission.STATUS_DECODING_FAILED
-			submission.save()
+			with timer.stage('decode'):
+				with monitor:
+					exit_code = docker.wait(identifier, timeout=submission.phase.timeout)
 
-			if error.returncode == 125:
-				logger.error('Unable to start Docker container')
-				logger.debug(error)
-				return 1
+			if exit_code:
+				submission.status = Submission.STATUS_DECODING_FAILED
+				submission.save()
 
-			elif error.returncode == 137:
 				# check if process was killed by OOMKiller
-				process = run('docker inspect {}'.format(identifier),
-					stdout=PIPE, stderr=PIPE, check=True, shell=True)
-
-				if '"OOMKilled": true' in process.stdout.decode():
+				if docker.inspect(identifier)['State'].get('OOMKilled'):
 					logger.error('The decoder exceeded the memory limit ({})'.format(
 						submission.phase.memory))
 					return 1
 
-			logger.error('The decoder has failed ({})'.format(error.returncode))
-			logger.debug(error)
-			return 1
+				logger.error('The decoder has failed ({})'.format(exit_code))
+				return 1
+
+			logger.info('Decoding complete')
+
+			submission.decoding_time = time.time() - start
+			submission.status = Submission.STATUS_DECODED
+			submission.save()
 
-		except TimeoutExpired:
+		except TimeoutError:
 			logger.error('Decoding exceeded the time limit ({} seconds)'.format(submission.phase.timeout))
+			try:
+				docker.kill(identifier)
+			except DockerError:
+				# decoder exited in the meantime
+				pass
 			return 1
 
 		finally:
 			# write decoder's output to logs
-			with open(log_file, 'ab') as handle:
-				docker_logs = run('docker logs {}'.format(identifier),
-					stdout=PIPE, stderr=STDOUT, check=False, shell=True)
-				handle.write(b'\n')
-				handle.write(docker_logs.stdout)
+			with timer.stage('docker_logs'):
+				with open(log_file, 'ab') as handle:
+					handle.write(b'\n')
+					handle.write(docker.logs(identifier))
 
 			# remove docker container
-			run('docker rm {}'.format(identifier),
-				stderr=PIPE, stdout=PIPE, check=False, shell=True)
+			docker.remove(identifier, force=True)
+
+			monitor.save(telemetry_file)
+			log_usage(logger, monitor.summary(), submission)
+
+			if uploader:
+				# wait for remaining outputs to be uploaded
+				with timer.stage('upload_outputs'):
+					uploader.stop()
+				logger.debug('Uploaded {} files while decoding'.format(len(uploader.uploaded)))
 
 	except:
 		logger.error('Some unexpected error occured')
@@ -257,31 +330,277 @@ def main(args):
 		return 1
 
 	finally:
+		if args.pipelined:
+			# the status of the submission tells the evaluation whether decoding was successful
+			mark(work_dir, DECODED_NAME)
+
 		# copy (intermediate) results back to submission directory
 		run('mv {log_file} {work_dir}'.format(log_file=log_file, work_dir=work_dir),
 			check=False,
 			shell=True)
-		run('gsutil -m rsync -e -C -R {work_dir} gs://{bucket}/{path}/'.format(
-				bucket=os.environ['BUCKET_SUBMISSIONS'],
-				path=submission.fs_path(),
-				work_dir=work_dir),
-			stdout=PIPE,
-			stderr=PIPE,
-			check=False,
-			shell=True)
-
-		# remove working directory
-		run('rm -rf {}'.format(work_dir), shell=True)
+		with timer.stage('upload'):
+			submissions.upload(
+				work_dir,
+				submission.fs_path(),
+				exclude='|'.join('^' + re.escape(name) + '$' for name in [MANIFEST_NAME, DECODED_NAME]),
+				check=False)
+
+		if args.pipelined:
+			# the evaluation removes the working directory once it is done
+			mark(work_dir, UPLOADED_NAME)
+		else:
+			# remove working directory
+			run('rm -rf {}'.format(work_dir), shell=True)
+
+		docker.close()
+
+		# store timings and profile
+		timer.save(timings_file)
+		if profiler:
+			profiler.disable()
+			profiler.dump_stats(profile_file)
+		submissions.upload_files(
+			[path for path in [timings_file, telemetry_file, profile_file] if os.path.exists(path)],
+			submission.fs_path(),
+			check=False)
+		run('rm -f {} {} {}'.format(timings_file, telemetry_file, profile_file), check=False, shell=True)
 
 	return 0
 
 
+def log_usage(logger, summary, submission):
+	"""
+	Logs a summary of the resources used by a decoder relative to the limits of the phase.
+	"""
+
+	if not summary:
+		logger.debug('No resource usage was recorded')
+		return
+
+	logger.info('Used {cpu_seconds:.1f} CPU seconds ({cpu_utilization:.2f} of {num_cpus} CPUs on average)'.format(
+		cpu_seconds=summary['cpu_seconds'],
+		cpu_utilization=summary['cpu_utilization'] or 0.,
+		num_cpus=submission.phase.cpu))
+	logger.info('Used up to {peak_memory:.0f}M of memory (limit: {memory_limit}M)'.format(
+		peak_memory=summary['peak_memory'] / 1024 / 1024,
+		memory_limit=submission.phase.memory))
+	logger.info('Read {read:.1f}M and wrote {write:.1f}M'.format(
+		read=summary['read_bytes'] / 1024 / 1024,
+		write=summary['write_bytes'] / 1024 / 1024))
+
+	if 'gpu_utilization' in summary:
+		logger.info('GPU utilization was {gpu_utilization:.0f}% on average and {peak_gpu_utilization:.0f}% at most, using up to {peak_gpu_memory:.0f}M of GPU memory'.format(
+			gpu_utilization=summary['gpu_utilization'],
+			peak_gpu_utilization=summary['peak_gpu_utilization'],
+			peak_gpu_memory=summary['peak_gpu_memory'] / 1024 / 1024))
+
+
+def container_config(identifier, work_dir, image, memory_limit, num_cpus, gpu=False):
+	"""
+	Configures the container running a decoder.
+
+	Parameters
+	----------
+	work_dir : str
+		Directory on the host containing the decoder and the submitted files
+
+	memory_limit : int
+		Memory available to the decoder in megabytes, which includes swap memory
+
+	Returns
+	-------
+	dict
+		Configuration as expected by the Docker Engine API
+	"""
+
+	binds = ['{work_dir}:/home/{identifier}'.format(work_dir=work_dir, identifier=identifier)]
+	devices = []
+
+	if gpu:
+		binds += [
+			'/home/kubernetes/bin/nvidia:/usr/local/nvidia:ro',
+			'/home/kubernetes/bin/nvidia/vulkan/icd.d:/etc/vulkan/icd.d:ro']
+		devices += [
+			{'PathOnHost': path, 'PathInContainer': path, 'CgroupPermissions': 'mrw'}
+			for path in GPU_DEVICES]
+
+	return {
+		'Image': image,
+		'Entrypoint': ['./' + EXECUTABLE_NAME],
+		'WorkingDir': '/home/{}'.format(identifier),
+		'Env': ['TF_CPP_MIN_LOG_LEVEL=3'],
+		'HostConfig': {
+			'NetworkMode': 'none',
+			'Memory': int(memory_limit) * 1024 * 1024,
+			'MemorySwap': int(memory_limit) * 1024 * 1024,
+			'NanoCpus': int(float(num_cpus) * 1e9),
+			'Binds': binds,
+			'Devices': devices,
+		},
+	}
+
+
+def cached_decoder(cache_dir, decoder_hash):
+	"""
+	Looks up an extracted decoder in the cache and marks it as recently used.
+
+	Returns
+	-------
+	str
+		Directory containing the extracted decoder, or `None` if the decoder is not cached
+	"""
+
+	if not cache_dir or not decoder_hash:
+		return None
+
+	decoder_dir = os.path.join(cache_dir, decoder_hash)
+
+	try:
+		# the modification time is used to determine which decoders were used least recently
+		os.utime(decoder_dir)
+	except OSError:
+		return None
+
+	return decoder_dir
+
+
+def cache_decoder(zip_path, cache_dir, decoder_hash):
+	"""
+	Extracts a zipped decoder into the cache.
+
+	Decoders are first extracted into a temporary directory and then moved into place, so that
+	other jobs never see partially extracted decoders.
+
+	Returns
+	-------
+	str
+		Directory containing the extracted decoder
+	"""
+
+	os.makedirs(cache_dir, exist_ok=True)
+
+	decoder_dir = os.path.join(cache_dir, decoder_hash)
+	tmp_dir = mkdtemp(dir=cache_dir, prefix='.tmp_')
+
+	try:
+		ZipFile(zip_path).extractall(tmp_dir)
+		os.chmod(tmp_dir, 0o755)
+		os.rename(tmp_dir, decoder_dir)
+	except OSError:
+		# another job may have cached the same decoder in the meantime
+		if not os.path.isdir(decoder_dir):
+			raise
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+
+	return decoder_dir
+
+
+def copy_decoder(decoder_dir, work_dir):
+	"""
+	Copies an extracted decoder into the working directory. Where supported by the file system,
+	files share their data with the cache until they are modified.
+	"""
+
+	run('cp -R -p --reflink=auto {decoder_dir}/. {work_dir}/'.format(
+			decoder_dir=decoder_dir,
+			work_dir=work_dir),
+		stdout=PIPE,
+		stderr=PIPE,
+		check=True,
+		shell=True)
+
+
+def evict_decoders(cache_dir, max_size, keep=[]):
+	"""
+	Removes least recently used decoders until the cache is no larger than `max_size` megabytes.
+
+	Parameters
+	----------
+	keep : list[str]
+		Directories of decoders which should not be removed
+
+	Returns
+	-------
+	list[str]
+		Directories of removed decoders
+	"""
+
+	entries = []
+	for name in os.listdir(cache_dir):
+		path = os.path.join(cache_dir, name)
+		if name.startswith('.tmp_') or not os.path.isdir(path):
+			continue
+		try:
+			entries.append((os.stat(path).st_mtime, _directory_size(path), path))
+		except OSError:
+			continue
+
+	total_size = sum(size for _, size, _ in entries)
+	evicted = []
+
+	for _, size, path in sorted(entries):
+		if total_size <= max_size * 1e6:
+			break
+		if path in keep:
+			continue
+		shutil.rmtree(path, ignore_errors=True)
+		total_size -= size
+		evicted.append(path)
+
+	return evicted
+
+
+def move_files(src_dir, dst_dir):
+	"""
+	Moves all files in a directory and its subdirectories into another directory on the same file
+	system, replacing existing files.
+	"""
+
+	for dir_path, _, file_names in os.walk(src_dir):
+		target_dir = os.path.join(dst_dir, os.path.relpath(dir_path, src_dir))
+		os.makedirs(target_dir, exist_ok=True)
+		for file_name in file_names:
+			os.replace(os.path.join(dir_path, file_name), os.path.join(target_dir, file_name))
+
+
+def _directory_size(path):
+	"""
+	Number of bytes used by files in a directory and its subdirectories.
+	"""
+
+	size = 0
+	for dir_path, _, file_names in os.walk(path):
+		for file_name in file_names:
+			try:
+				size += os.lstat(os.path.join(dir_path, file_name)).st_size
+			except OSError:
+				pass
+	return size
+
+
 if __name__ == '__main__':
 	parser = ArgumentParser()
 	parser.add_argument('--id', type=int, required=True,
 		help='Used to identify the submission')
 	parser.add_argument('--exec_dir', type=str, default='/var/lib/docker/submissions',
 		help='Location of executable directory which exists both on host and inside container')
+	parser.add_argument('--decoder_cache', type=str, default='/var/lib/docker/decoders',
+		help='Extracted decoders are cached in this directory on the host, set to empty string to disable')
+	parser.add_argument('--decoder_cache_size', type=float, default=20000.,
+		help='Maximum size of the decoder cache in megabytes')
+	parser.add_argument('--docker_socket', type=str, default=SOCKET_PATH,
+		help='Unix socket of the Docker daemon on the host')
+	parser.add_argument('--telemetry_interval', type=float, default=1.,
+		help='Number of seconds between samples of the resource usage of the decoder')
+	parser.add_argument('--upload_interval', type=float, default=10.,
+		help='Number of seconds between uploads of outputs while the decoder runs, 0 disables uploads during decoding')
+	parser.add_argument('--prefetch_state_file', type=str, default=STATE_FILE,
+		help='Records of Docker images pulled by prefetch.py')
+	parser.add_argument('--prefetch_max_age', type=float, default=900.,
+		help='Docker images prefetched less than this many seconds ago are not pulled again')
+	parser.add_argument('--pipelined', action='store_true',
+		help='Share outputs with an evaluation running at the same time')
 	parser.add_argument('--debug', action='store_true')
 
 	args = parser.parse_args()
@@ -0,0 +1,359 @@
+"""
+A minimal client of the Docker Engine API.
+
+Requests are sent over the Unix socket of the Docker daemon, reusing a single connection, instead
+of starting a `docker` process for each step of a container's lifecycle. Responses are decoded
+from JSON, so that the state of containers does not have to be parsed from the output of the
+command line tool.
+"""
+
+import http.client
+import json
+import select
+import socket
+import struct
+from base64 import urlsafe_b64encode
+from urllib.parse import quote, urlencode
+
+SOCKET_PATH = '/var/run/docker.sock'
+
+# indicates that the default timeout of the client should be used
+_DEFAULT_TIMEOUT = object()
+
+# requests using these methods can safely be sent again
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE'}
+
+
+class DockerError(Exception):
+	"""
+	Raised if the Docker daemon responds with an error.
+	"""
+
+	def __init__(self, status, message):
+		super().__init__(f'{message} ({status})')
+		self.status = status
+		self.message = message
+
+
+class NotFoundError(DockerError):
+	"""
+	Raised if a container or image does not exist.
+	"""
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+	"""
+	HTTP connection over a Unix socket.
+	"""
+
+	def __init__(self, socket_path, timeout=None):
+		super().__init__('localhost', timeout=timeout)
+		self.socket_path = socket_path
+
+	def connect(self):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.sock.settimeout(self.timeout)
+		self.sock.connect(self.socket_path)
+
+
+class DockerClient:
+	"""
+	Creates, runs and inspects containers.
+
+	Parameters
+	----------
+	socket_path : str
+		Unix socket on which the Docker daemon listens
+
+	timeout : float
+		Number of seconds after which requests are aborted, unless specified otherwise
+	"""
+
+	def __init__(self, socket_path=SOCKET_PATH, timeout=60.):
+		self.socket_path = socket_path
+		self.timeout = timeout
+		self._connection = None
+
+	def close(self):
+		if self._connection is not None:
+			self._connection.close()
+			self._connection = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+	def ping(self):
+		"""
+		Checks whether the Docker daemon is reachable.
+		"""
+
+		return self._request('GET', '/_ping') == b'OK'
+
+	def create_container(self, name, config):
+		"""
+		Creates a container without starting it.
+
+		Parameters
+		----------
+		name : str
+			Name of the container
+
+		config : dict
+			Configuration of the container as expected by the Docker Engine API, for example,
+			`{'Image': 'ubuntu', 'Cmd': ['ls'], 'HostConfig': {'Memory': 1 << 30}}`
+
+		Returns
+		-------
+		str
+			ID of the container
+		"""
+
+		return self._request('POST', '/containers/create', params={'name': name}, body=config)['Id']
+
+	def start(self, container):
+		self._request('POST', f'/containers/{quote(container)}/start')
+
+	def wait(self, container, timeout=None):
+		"""
+		Waits until a container stops running. The Docker daemon responds as soon as the container
+		exits, so that its state does not need to be polled.
+
+		Parameters
+		----------
+		timeout : float
+			Number of seconds after which to stop waiting, or `None` to wait indefinitely
+
+		Returns
+		-------
+		int
+			Exit code of the container
+
+		Raises
+		------
+		TimeoutError
+			If the container is still running after `timeout` seconds
+		"""
+
+		try:
+			response = self._request(
+				'POST',
+				f'/containers/{quote(container)}/wait',
+				params={'condition': 'not-running'},
+				timeout=timeout)
+		except socket.timeout:
+			raise TimeoutError(f'Container {container} did not exit within {timeout} seconds')
+		return response['StatusCode']
+
+	def inspect(self, container):
+		"""
+		Returns
+		-------
+		dict
+			Low-level information about a container, including its state, such as `OOMKilled`
+		"""
+
+		return self._request('GET', f'/containers/{quote(container)}/json')
+
+	def logs(self, container):
+		"""
+		Returns
+		-------
+		bytes
+			Output which the container wrote to stdout and stderr, in the order it was written
+		"""
+
+		data = self._request(
+			'GET',
+			f'/containers/{quote(container)}/logs',
+			params={'stdout': 1, 'stderr': 1})
+
+		if self.inspect(container)['Config'].get('Tty'):
+			return data
+
+		# without TTY, outputs are multiplexed into frames of the form (stream, 0, 0, 0, size, data)
+		chunks = []
+		offset = 0
+		while offset + 8 <= len(data):
+			size, = struct.unpack('>I', data[offset + 4:offset + 8])
+			chunks.append(data[offset + 8:offset + 8 + size])
+			offset += 8 + size
+		return b''.join(chunks)
+
+	def stats(self, container):
+		"""
+		Returns
+		-------
+		dict
+			A single sample of the resource usage of a container, including its CPU time, memory
+			usage and block I/O
+		"""
+
+		return self._request(
+			'GET',
+			f'/containers/{quote(container)}/stats',
+			params={'stream': 0, 'one-shot': 1})
+
+	def stop(self, container, timeout=10):
+		"""
+		Stops a container, killing it if it does not exit within `timeout` seconds.
+		"""
+
+		self._request(
+			'POST',
+			f'/containers/{quote(container)}/stop',
+			params={'t': timeout},
+			timeout=self.timeout + timeout)
+
+	def kill(self, container):
+		self._request('POST', f'/containers/{quote(container)}/kill')
+
+	def remove(self, container, force=False):
+		"""
+		Removes a container. Running containers are only removed if `force` is set.
+		"""
+
+		self._request('DELETE', f'/containers/{quote(container)}', params={'force': int(force)})
+
+	def pull(self, image, auth=None, timeout=3600.):
+		"""
+		Pulls an image from a registry.
+
+		Parameters
+		----------
+		image : str
+			Name of the image, optionally including a tag or digest
+
+		auth : dict
+			Credentials of the registry, such as `{'username': ..., 'password': ...}`
+		"""
+
+		name, tag = split_image_name(image)
+		headers = {}
+		if auth is not None:
+			headers['X-Registry-Auth'] = urlsafe_b64encode(json.dumps(auth).encode()).decode()
+
+		data = self._request(
+			'POST',
+			'/images/create',
+			params={'fromImage': name, 'tag': tag},
+			headers=headers,
+			timeout=timeout,
+			decode=False)
+
+		# progress is reported as a stream of JSON objects, errors may occur at any point
+		for line in data.splitlines():
+			if not line.strip():
+				continue
+			message = json.loads(line.decode())
+			if 'error' in message:
+				raise DockerError(500, message['error'])
+
+	def inspect_image(self, image):
+		"""
+		Returns
+		-------
+		dict
+			Low-level information about a local image, including its `Id`
+		"""
+
+		return self._request('GET', f'/images/{image}/json')
+
+	def _request(self, method, path, params=None, body=None, headers={}, timeout=_DEFAULT_TIMEOUT, decode=True):
+		"""
+		Sends a request to the Docker daemon.
+
+		The connection is kept open between requests. If the daemon closed it in the meantime, a new
+		connection is used. Requests which failed because the connection was closed while they were
+		sent are only sent again if they are idempotent, since the daemon may have received them.
+
+		Returns
+		-------
+		dict or bytes
+			The decoded JSON response, or the raw response if it is not JSON or `decode` is `False`
+		"""
+
+		url = path + ('?' + urlencode(params) if params else '')
+		headers = dict(headers)
+		if body is not None:
+			body = json.dumps(body).encode()
+			headers['Content-Type'] = 'application/json'
+
+		for attempt in range(2):
+			if self._connection is not None and _is_closed(self._connection):
+				self.close()
+
+			reused = self._connection is not None
+			if not reused:
+				self._connection = UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+			connection = self._connection
+
+			# timeouts apply to individual requests
+			connection.timeout = self.timeout if timeout is _DEFAULT_TIMEOUT else timeout
+			if connection.sock is not None:
+				connection.sock.settimeout(connection.timeout)
+
+			try:
+				connection.request(method, url, body=body, headers=headers)
+				response = connection.getresponse()
+				data = response.read()
+				break
+			except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+				self.close()
+				if not reused or attempt > 0 or method not in IDEMPOTENT_METHODS:
+					raise
+			except:
+				# the state of the connection is unknown
+				self.close()
+				raise
+
+		if response.getheader('Connection', '').lower() == 'close':
+			self.close()
+
+		if response.status >= 400:
+			try:
+				message = json.loads(data.decode())['message']
+			except (ValueError, KeyError, UnicodeDecodeError):
+				message = data.decode(errors='replace').strip() or response.reason
+			if response.status == 404:
+				raise NotFoundError(response.status, message)
+			raise DockerError(response.status, message)
+
+		if decode and data and response.getheader('Content-Type', '').startswith('application/json'):
+			return json.loads(data.decode())
+		return data
+
+
+def _is_closed(connection):
+	"""
+	Checks whether the other end closed an idle connection. Since no data is expected on an idle
+	connection, it is considered closed if its socket is readable.
+	"""
+
+	if connection.sock is None:
+		return False
+	try:
+		return bool(select.select([connection.sock], [], [], 0)[0])
+	except (OSError, ValueError):
+		return True
+
+
+def split_image_name(image):
+	"""
+	Splits the name of an image into repository and tag or digest.
+
+	Returns
+	-------
+	tuple
+		Repository and tag, where the tag is `latest` if none is given
+	"""
+
+	if '@' in image:
+		return tuple(image.split('@', 1))
+	repository, _, tag = image.rpartition(':')
+	if not repository or '/' in tag:
+		# colon belongs to the port of a registry
+		return image, 'latest'
+	return repository, tag
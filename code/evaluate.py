@@ -1,22 +1,39 @@
 #!/usr/bin/env python3
 
+import cProfile
 import os
 import sys
+import json
 import traceback
 import numpy as np
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from glob import glob
 from subprocess import run, PIPE
 from tempfile import mkdtemp
-from utils import get_logger, get_submission, sql_setup
-from PIL import Image
-from metrics import evaluate
+from utils import Timer, get_logger, get_submission, sql_setup
+from metrics import KEYED_CACHE_FILES, evaluate, image_size, image_sizes, parse_settings
+from pipeline import UPLOADED_NAME, DecoderOutputs, wait_for_marker
+from storage import get_storage, run_concurrently
+from video import check_sequences, find_sequences
+from video import evaluate as evaluate_sequences
 
 
 def main(args):
 	log_file = os.path.join(mkdtemp(), '.log_evaluate')
 	logger = get_logger(debug=args.debug, filename=log_file)
 
+	# time spent in each stage of the evaluation
+	timer = Timer()
+	timings_file = os.path.join(os.path.dirname(log_file), '.timings_evaluate.json')
+
+	# in debug mode, the evaluation is additionally profiled
+	profiler = None
+	profile_file = os.path.join(os.path.dirname(log_file), '.profile_evaluate')
+	if args.debug:
+		profiler = cProfile.Profile()
+		profiler.enable()
+
 	try:
 		logger.debug('Connecting to SQL database')
 		sql_setup()
@@ -33,8 +50,9 @@ def main(args):
 
 		logger.info('Obtaining submission')
 		submission = get_submission(id=args.id)
-		submission.status = Submission.STATUS_EVALUATING
-		submission.save()
+		if not args.pipelined_dir:
+			submission.status = Submission.STATUS_EVALUATING
+			submission.save()
 	except ObjectDoesNotExist:
 		logger.error('Could not find submission')
 		return 1
@@ -43,7 +61,7 @@ def main(args):
 		logger.debug(traceback.format_exc())
 		return 1
 
-	# ativate service account (needed for gsutil)
+	# ativate service account (needed for gsutil, unless buckets are stored locally)
 	run('gcloud auth activate-service-account --quiet --key-file={key_file}'.format(
 			key_file=os.environ.get('GOOGLE_APPLICATION_CREDENTIALS')),
 		stdout=PIPE,
@@ -51,142 +69,423 @@ def main(args):
 		check=False,
 		shell=True)
 
-	# obtain submission
-	logger.info('Obtaining decoded images')
-	submission_dir = '/submission'
-	run('mkdir -p {dir}'.format(dir=submission_dir), shell=True)
-	run('gsutil -m rsync -e -R gs://{bucket}/{path}/ {submission_dir}'.format(
-			bucket=os.environ['BUCKET_SUBMISSIONS'],
-			path=submission.fs_path(),
-			submission_dir=submission_dir),
-		stdout=PIPE,
-		stderr=PIPE,
-		check=True,
-		shell=True)
+	# in pipelined mode, decoded images are read from the decoder's working directory
+	outputs = None
+
+	def decoding_failed():
+		# decode.py may have stopped without marking the end of decoding
+		status = Submission.objects.filter(id=submission.id).values_list('status', flat=True).first()
+		return status in [
+			Submission.STATUS_ERROR,
+			Submission.STATUS_DECODING_FAILED,
+			Submission.STATUS_CANCELED]
+
+	def wait_for_decoder():
+		# returns whether decoding was successful
+		with timer.stage('wait_for_decoder'):
+			outputs.wait_done()
+		submission.refresh_from_db()
+		if outputs.timed_out:
+			logger.error('Timed out waiting for the decoder')
+			submission.status = Submission.STATUS_ERROR
+			submission.save()
+			return False
+		if submission.status != Submission.STATUS_DECODED:
+			logger.error('Decoding failed')
+			return False
+		submission.status = Submission.STATUS_EVALUATING
+		submission.save()
+		return True
+
+	# storage buckets
+	submissions = get_storage(os.environ['BUCKET_SUBMISSIONS'])
+	targets = get_storage(os.environ['BUCKET_TARGETS'])
+	caches = get_storage(os.environ.get('BUCKET_CACHE', os.environ['BUCKET_TARGETS']))
+	phase_path = os.path.join(submission.task.name, submission.phase.name)
+	cache_path = os.path.join('.cache', phase_path)
+
+	# decoded images, target images and data cached by previous evaluations of this phase are
+	# obtained at the same time
+	transfers = {}
+
+	if args.pipelined_dir:
+		logger.info('Evaluating decoded images as they are created')
+		submission_dir = os.path.join(args.pipelined_dir, str(submission.id))
+		outputs = DecoderOutputs(submission_dir,
+			failed=decoding_failed,
+			timeout=submission.phase.timeout + args.pipelined_timeout)
+
+		# results checkpointed by a previous attempt of this evaluation
+		checkpoint_dir = os.path.join(os.path.dirname(log_file), '.checkpoint_evaluate')
+		run('mkdir -p {dir}'.format(dir=checkpoint_dir), shell=True)
+		transfers['download_checkpoint'] = lambda: submissions.download(
+			os.path.join(submission.fs_path(), '.checkpoint_evaluate'), checkpoint_dir, check=False)
+	else:
+		logger.info('Obtaining decoded images')
+		submission_dir = '/submission'
+		run('mkdir -p {dir}'.format(dir=submission_dir), shell=True)
+		transfers['download_submission'] = lambda: submissions.download(
+			submission.fs_path(), submission_dir)
 
-	# obtain target images
 	logger.info('Obtaining target images')
 	target_dir = '/target'
 	run('mkdir -p {dir}'.format(dir=target_dir), shell=True)
-	run('gsutil -m rsync -e -R gs://{bucket}/{path}/ {target_dir}'.format(
-			bucket=os.environ['BUCKET_TARGETS'],
-			path=os.path.join(submission.task.name, submission.phase.name),
-			target_dir=target_dir),
-		stdout=PIPE,
-		stderr=PIPE,
-		check=True,
-		shell=True)
+	transfers['download_targets'] = lambda: targets.download(phase_path, target_dir)
+
+	logger.info('Obtaining cache')
+	cache_dir = '/cache'
+	run('mkdir -p {dir}'.format(dir=cache_dir), shell=True)
+	transfers['download_cache'] = lambda: caches.download(
+		cache_path, cache_dir, exclude=KEYED_CACHE_FILES, check=False)
+
+	def fetch_cache(path):
+		# cached files depending on the targets and settings are only obtained if they are needed
+		caches.download_file(os.path.join(cache_path, os.path.basename(path)), cache_dir, check=False)
+
+	# per-sequence results of video tracks
+	sequences_file = os.path.join(os.path.dirname(log_file), 'sequences.json')
 
 	try:
-		# check images
-		target_images = glob(os.path.join(target_dir, '*.png'))
-		any_images = len(target_images) > 0
-		target_images += glob(os.path.join(target_dir, '*.csv'))
-		target_images = {os.path.basename(path): path for path in target_images}
-		submission_images = glob(os.path.join(submission_dir, '**/*.png'), recursive=True)
-		submission_images += glob(os.path.join(submission_dir, '**/*.csv'), recursive=True)
-		submission_images = {os.path.basename(path): path for path in submission_images}
-
-		if any_images:
-			logger.info('Checking image dimensions')
-
-		if not target_images:
-			logger.error('Failed to locate target files')
+		with timer.stage('download'):
+			transfers = run_concurrently(transfers)
+		for name, transfer in transfers.items():
+			timer.add(name, transfer.seconds)
+
+		errors = [transfer.error for transfer in transfers.values() if transfer.error]
+		if errors:
+			for error in errors:
+				logger.error('Failed to obtain files: {}'.format(error))
+			if outputs is not None:
+				# avoid that the status is overwritten by the decoder
+				outputs.wait_done()
+				submission.refresh_from_db()
 			submission.status = Submission.STATUS_ERROR
 			submission.save()
 			return 1
 
-		for name in target_images:
-			# check if image is present
-			if name not in submission_images:
-				if name.endswith('.csv') and \
-						len(submission_images) == 1 and \
-						len(target_images) == 1:
-					# hack so that CSV file can be named anything in perceptual track
-					path = list(submission_images.values())[0]
-					if path.lower().endswith('.csv'):
-						submission_images[name] = path
-						continue
+		settings = parse_settings(submission.phase.settings)
+
+		# images are evaluated while they are decoded, other files only after decoding finished
+		target_files = os.listdir(target_dir)
+		pipelined = outputs is not None and 'video' not in settings and \
+			any(name.endswith('.png') for name in target_files) and \
+			not any(name.endswith('.csv') for name in target_files)
+
+		if outputs is not None and not pipelined:
+			if not wait_for_decoder():
+				return 1
+
+		if 'video' in settings:
+			# check video sequences
+			logger.info('Checking video sequences')
 
-				logger.error('Submission is missing file: {}'.format(name))
+			target_sequences = find_sequences(target_dir, settings['video'])
+			submission_sequences = find_sequences(submission_dir, settings['video'], recursive=True)
+
+			if not target_sequences:
+				logger.error('Failed to locate target sequences')
+				submission.status = Submission.STATUS_ERROR
+				submission.save()
+				return 1
+
+			for name in target_sequences:
+				if name not in submission_sequences:
+					logger.error('Submission is missing sequence: {}'.format(name))
+					submission.status = Submission.STATUS_EVALUATION_FAILED
+					submission.save()
+					return 1
+
+			with timer.stage('check_sequences'):
+				layouts, error = check_sequences(
+					list(target_sequences), submission_sequences, target_sequences, settings['video'])
+
+			if error:
+				logger.error(error)
 				submission.status = Submission.STATUS_EVALUATION_FAILED
 				submission.save()
 				return 1
 
-			if name.endswith('.csv'):
-				continue
+			# start actual evaluation
+			logger.info('Running evaluation')
+			with timer.stage('evaluate'):
+				results, sequence_results = evaluate_sequences(
+					submission_sequences,
+					target_sequences,
+					layouts,
+					settings=settings,
+					logger=logger)
+
+			with open(sequences_file, 'w') as handle:
+				json.dump(sequence_results, handle)
+
+		elif pipelined:
+			target_images = glob(os.path.join(target_dir, '*.png'))
+			target_images = {os.path.basename(path): path for path in target_images}
+			image_names = list(target_images)
 
-			# check if image has correct size
-			image_size = Image.open(submission_images[name]).size
-			target_size = Image.open(target_images[name]).size
+			with timer.stage('target_sizes'):
+				sizes = dict(zip(image_names, image_sizes([target_images[name] for name in image_names])))
 
-			if image_size != target_size:
-				logger.error(
-					'Image {name} has incorrect size ({image_size} instead of {target_size})'.format(
-						name=name,
-						image_size='x'.join(map(str, image_size)),
-						target_size='x'.join(map(str, target_size))))
+			def wait(name):
+				path = outputs.wait(name)
+				if path is None:
+					raise SubmissionError('Submission is missing file: {}'.format(name))
+				try:
+					submission_size = image_size(path)
+				except (IOError, SyntaxError):
+					submission_size = None
+				if submission_size != sizes[name]:
+					raise SubmissionError(size_error(name, submission_size, sizes[name]))
+				return path
+
+			# start actual evaluation
+			logger.info('Running evaluation')
+			try:
+				with timer.stage('evaluate'):
+					results = evaluate(
+						{},
+						target_images,
+						settings=settings,
+						logger=logger,
+						cache_dir=cache_dir,
+						fetch_cache=fetch_cache,
+						sizes=sizes,
+						checkpoint_dir=checkpoint_dir,
+						on_checkpoint=lambda checkpoint_dir: upload_checkpoint(checkpoint_dir, submission),
+						timer=timer,
+						wait=wait)
+			except SubmissionError as error:
+				if not wait_for_decoder():
+					return 1
+				logger.error(str(error))
 				submission.status = Submission.STATUS_EVALUATION_FAILED
 				submission.save()
 				return 1
 
-		# start actual evaluation
-		logger.info('Running evaluation')
-		results = evaluate(
-			submission_images,
-			target_images,
-			settings=submission.phase.settings,
-			logger=logger)
+			if not wait_for_decoder():
+				return 1
 
-		with transaction.atomic():
-			for metric, value in results.items():
-				logger.info(f'{metric}: {value}')
+		else:
+			# check images
+			target_images = glob(os.path.join(target_dir, '*.png'))
+			any_images = len(target_images) > 0
+			target_images += glob(os.path.join(target_dir, '*.csv'))
+			target_images = {os.path.basename(path): path for path in target_images}
+			submission_images = glob(os.path.join(submission_dir, '**/*.png'), recursive=True)
+			submission_images += glob(os.path.join(submission_dir, '**/*.csv'), recursive=True)
+			submission_images = {os.path.basename(path): path for path in submission_images}
 
-				if np.isnan(value):
-					logger.warning(f'Evaluation of {metric} failed')
-					continue
+			if any_images:
+				logger.info('Checking image dimensions')
 
-				measurement = Measurement(
-					metric=metric,
-					value=value,
-					submission=submission)
-				measurement.save()
+			if not target_images:
+				logger.error('Failed to locate target files')
+				submission.status = Submission.STATUS_ERROR
+				submission.save()
+				return 1
+
+			for name in target_images:
+				# check if image is present
+				if name not in submission_images:
+					if name.endswith('.csv') and \
+							len(submission_images) == 1 and \
+							len(target_images) == 1:
+						# hack so that CSV file can be named anything in perceptual track
+						path = list(submission_images.values())[0]
+						if path.lower().endswith('.csv'):
+							submission_images[name] = path
+							continue
+
+					logger.error('Submission is missing file: {}'.format(name))
+					submission.status = Submission.STATUS_EVALUATION_FAILED
+					submission.save()
+					return 1
+
+			# check if images have correct sizes
+			image_names = [name for name in target_images if not name.endswith('.csv')]
+			with timer.stage('check_sizes'):
+				sizes, error = check_sizes(image_names, submission_images, target_images)
+
+			if error:
+				logger.error(error)
+				submission.status = Submission.STATUS_EVALUATION_FAILED
+				submission.save()
+				return 1
+
+			# start actual evaluation
+			logger.info('Running evaluation')
+			with timer.stage('evaluate'):
+				results = evaluate(
+					submission_images,
+					target_images,
+					settings=settings,
+					logger=logger,
+					cache_dir=cache_dir,
+					fetch_cache=fetch_cache,
+					sizes=sizes,
+					checkpoint_dir=os.path.join(submission_dir, '.checkpoint_evaluate'),
+					on_checkpoint=lambda checkpoint_dir: upload_checkpoint(checkpoint_dir, submission),
+					timer=timer)
+
+		with timer.stage('store_results'):
+			with transaction.atomic():
+				for metric, value in results.items():
+					logger.info(f'{metric}: {value}')
+
+					if np.isnan(value):
+						logger.warning(f'Evaluation of {metric} failed')
+						continue
+
+					measurement = Measurement(
+						metric=metric,
+						value=value,
+						submission=submission)
+					measurement.save()
 
 		submission.status = Submission.STATUS_SUCCESS
 		submission.save()
 
+		# results of a future evaluation should not depend on this evaluation
+		submissions.remove(os.path.join(submission.fs_path(), '.checkpoint_evaluate'), check=False)
+
 		logger.info('Evaluation complete')
 
 	except:
 		logger.error('Some unexpected error occured')
 		logger.debug(traceback.format_exc())
+		if outputs is not None:
+			# avoid that the status is overwritten by the decoder
+			outputs.wait_done()
+			submission.refresh_from_db()
 		submission.status = Submission.STATUS_ERROR
 		submission.save()
 		return 1
 
 	finally:
 		# store logs
-		run('gsutil cp {log_file} gs://{bucket}/{path}/'.format(
-				log_file=log_file,
-				bucket=os.environ['BUCKET_SUBMISSIONS'],
-				path=submission.fs_path()),
-			stdout=PIPE,
-			stderr=PIPE,
-			check=False,
-			shell=True)
+		with timer.stage('upload_logs'):
+			submissions.upload_files([log_file], submission.fs_path(), check=False)
 		run('rm {log_file}'.format(log_file=log_file), check=False, shell=True)
 
+		if os.path.exists(sequences_file):
+			submissions.upload_files([sequences_file], submission.fs_path(), check=False)
+			run('rm {sequences_file}'.format(sequences_file=sequences_file), check=False, shell=True)
+
+		# store cached data for future evaluations, after a successful evaluation cached data it did
+		# not use is removed, such as data of previous targets or settings
+		with timer.stage('upload_cache'):
+			caches.upload(
+				cache_dir,
+				cache_path,
+				exclude='.*\\.tmp$',
+				delete=submission.status == Submission.STATUS_SUCCESS,
+				check=False)
+
 		# unmount buckets
+		if outputs is not None:
+			# the decoder's working directory is removed once its files have been uploaded
+			wait_for_marker(submission_dir, UPLOADED_NAME, timeout=args.pipelined_timeout)
 		run('rm -rf {}'.format(submission_dir), shell=True)
 		run('rm -rf {}'.format(target_dir), shell=True)
+		run('rm -rf {}'.format(cache_dir), shell=True)
+
+		# store timings and profile
+		timer.save(timings_file)
+		if profiler:
+			profiler.disable()
+			profiler.dump_stats(profile_file)
+		submissions.upload_files(
+			[path for path in [timings_file, profile_file] if os.path.exists(path)],
+			submission.fs_path(),
+			check=False)
+		run('rm -f {} {}'.format(timings_file, profile_file), check=False, shell=True)
 
 	return 0
 
 
+class SubmissionError(Exception):
+	"""
+	Raised if a submitted file is missing or invalid.
+	"""
+
+
+def upload_checkpoint(checkpoint_dir, submission):
+	"""
+	Copies checkpoint files to the submission's directory, where they are found by a restarted
+	evaluation.
+	"""
+
+	get_storage(os.environ['BUCKET_SUBMISSIONS']).upload(
+		checkpoint_dir,
+		os.path.join(submission.fs_path(), '.checkpoint_evaluate'),
+		exclude='.*\\.tmp$',
+		check=False)
+
+
+def check_sizes(names, submission_images, target_images):
+	"""
+	Compares the sizes of submitted images to the sizes of the target images.
+
+	Sizes are read from image headers in parallel. The check stops at the first image whose size
+	differs from the size of its target.
+
+	Returns
+	-------
+	tuple
+		A dictionary mapping names to sizes as `(height, width)` and an error message, which is
+		`None` if all images have the correct size
+	"""
+
+	def read_sizes(name):
+		try:
+			return image_size(submission_images[name]), image_size(target_images[name])
+		except (IOError, SyntaxError):
+			return None, image_size(target_images[name])
+
+	sizes = {}
+
+	with ThreadPoolExecutor() as executor:
+		futures = {executor.submit(read_sizes, name): name for name in names}
+
+		for future in as_completed(futures):
+			name = futures[future]
+			submission_size, target_size = future.result()
+
+			if submission_size != target_size:
+				# skip remaining images
+				for future in futures:
+					future.cancel()
+
+				return sizes, size_error(name, submission_size, target_size)
+
+			sizes[name] = target_size
+
+	return sizes, None
+
+
+def size_error(name, submission_size, target_size):
+	"""
+	Describes why the size of a submitted image is incorrect.
+	"""
+
+	if submission_size is None:
+		return 'Image {name} could not be read'.format(name=name)
+
+	return 'Image {name} has incorrect size ({image_size} instead of {target_size})'.format(
+		name=name,
+		image_size='x'.join(map(str, submission_size[::-1])),
+		target_size='x'.join(map(str, target_size[::-1])))
+
+
 if __name__ == '__main__':
 	parser = ArgumentParser()
 	parser.add_argument('--id', type=int, required=True,
 		help='Used to identify the submission')
+	parser.add_argument('--pipelined_dir', type=str,
+		help='Evaluate images while they are decoded into this directory on the host')
+	parser.add_argument('--pipelined_timeout', type=float, default=3600.,
+		help='Maximum number of seconds to wait for the decoder beyond the time limit of the phase, '
+			'and for the decoder to upload its outputs')
 	parser.add_argument('--debug', action='store_true')
 
 	args = parser.parse_args()
@@ -1,50 +1,109 @@
 import os
 import csv
+import io
+import struct
+import time
+from collections import deque
+from contextlib import nullcontext
+from itertools import tee
+from glob import glob
 import numpy as np
 import json
 import mmd
+from cache import cache_key, cache_path, hash_file
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from PIL import Image
-from msssim import MultiScaleSSIM
+from msssim import BACKENDS as MSSSIM_BACKENDS, MultiScaleSSIMTiled
 
-def evaluate(submission_files, target_files, settings={}, logger=None):
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# images of these types are compared using integer arithmetic
+INTEGER_DTYPES = (np.dtype(np.uint8), np.dtype(np.uint16))
+
+# values of metrics of individual images are cached in this file
+IMAGE_METRICS_NAME = 'image_metrics.json'
+
+# cached files which are only obtained when an evaluation needs them
+KEYED_CACHE_FILES = r'(targets|inception_codes|csv)_[0-9a-f]{56}\.(npy|json)$'
+
+# approximate peak memory needed by MS-SSIM per value of an image (bytes)
+MSSSIM_BYTES_PER_VALUE = {'reference': 136, 'fast': 64}
+
+
+def evaluate(submission_files, target_files, settings={}, logger=None, cache_dir=None, sizes=None,
+        checkpoint_dir=None, on_checkpoint=None, timer=None, wait=None, fetch_cache=None):
     """
     Calculates metrics for the given images.
+
+    Data which only depends on the targets is cached in `cache_dir`, if given. Cached files which
+    do not exist yet are first requested with `fetch_cache(path)`, if given. Image sizes already
+    known to the caller can be passed as a dictionary mapping names to `(height, width)`.
+
+    If `checkpoint_dir` is given, results of evaluated images are regularly stored there and
+    `on_checkpoint(checkpoint_dir)` is called afterwards. Images found in an existing checkpoint
+    are not evaluated again, unless the contents of the target or the submitted image changed.
+
+    If a `timer` is given, the time spent in different stages of the evaluation is recorded using
+    `timer.stage(name)` and `timer.add(name, seconds)`.
+
+    If `wait` is given, submitted images may still be in the process of being created. Before an
+    image is loaded, `wait(name)` is called, which should block until the image is complete and
+    return its path. Images are then evaluated as soon as they become available. Since submitted
+    images are not known in advance, their metrics are not cached in this case.
     """
 
-    if settings is None:
-        settings = {}
-    if isinstance(settings, str):
-        try:
-            settings = json.loads(settings)
-        except json.JSONDecodeError:
-            settings = {}
+    settings = parse_settings(settings)
+
+    def stage(name):
+        return timer.stage(name) if timer else nullcontext()
 
     metrics = settings.get('metrics', ['PSNR', 'MSSSIM'])
     patch_size = settings.get('patch_size', 256)
 
+    # options needed to evaluate a single pair of images
+    options = {
+        'metrics': metrics,
+        'patch_size': patch_size,
+        'msssim_backend': settings.get('msssim_backend', 'reference'),
+        'tile_memory': settings.get('tile_memory'),
+    }
+
+    # images can be evaluated by a pool of processes or threads
+    num_workers = settings.get('num_workers', 1) or os.cpu_count()
+    executor = settings.get('executor', 'process')
+
+    # without workers, images are decoded ahead of time on separate threads
+    prefetch_depth = settings.get('prefetch', 2)
+    prefetch_memory = settings.get('prefetch_memory', 1024) * 1e6
+
     num_dims = 0
     sqerror_values = []
     msssim_values = []
     accuracy_values = []
 
-    # used by FID
+    # used by FID and KID
     target_patches = []
     submission_patches = []
-    rs = np.random.RandomState(0)
+
+    image_names = []
 
     for file_idx, name in enumerate(target_files):
         if name.endswith('.csv'):
-            file0 = read_csv(target_files[name], logger)
-            file1 = read_csv(submission_files[name], logger)
+            # the targets only need to be parsed once per phase
+            with stage('read_csv'):
+                file0 = read_csv(
+                    target_files[name], logger, cache_dir=cache_dir, fetch_cache=fetch_cache)
+                file1 = read_csv(submission_files[name], logger)
 
             if file0 is None:
                 logger.error('Failed to load targets')
             if file1 is None:
                 logger.error('Could not read CSV file')
 
-            if file0 and file1:
+            if file0 is not None and file1 is not None:
                 if 'accuracy' in metrics:
-                    value = accuracy(file0, file1, logger)
+                    with stage('accuracy'):
+                        value = accuracy(file0, file1, logger)
                     if value is None or np.isnan(value):
                         logger.error('Evaluation of accuracy failed, assuming accuracy of 0%')
                         accuracy_values.append(0.0)
@@ -52,29 +111,234 @@ def evaluate(submission_files, target_files, settings={}, logger=None):
                         accuracy_values.append(value)
 
         else:
-            logger.debug(f'Metrics for image number `{file_idx}` of `{len(target_files)}`: `{name}`')
-            image0 = np.asarray(Image.open(target_files[name]).convert('RGB'), dtype=np.float32)
-            image1 = np.asarray(Image.open(submission_files[name]).convert('RGB'), dtype=np.float32)
-
-            num_dims += image0.size
-
-            if 'PSNR' in metrics:
-                sqerror_values.append(mse(image1, image0))
-            if 'MSSSIM' in metrics:
-                value = msssim(image0, image1) * image0.size
-                if np.isnan(value):
-                    value = 0.0
-                    if logger:
-                        logger.warning(
-                                f'Evaluation of MSSSIM for `{name}` returned NaN. Assuming MSSSIM is zero.')
-                msssim_values.append(value)
-            if 'KID' in metrics or 'FID' in metrics:
-                if image0.shape[0] >= patch_size and image0.shape[1] >= patch_size:
-                    # extract random patches for later use
-                    i = rs.randint(image0.shape[0] - patch_size + 1)
-                    j = rs.randint(image0.shape[1] - patch_size + 1)
-                    target_patches.append(image0[i:i + patch_size, j:j + patch_size])
-                    submission_patches.append(image1[i:i + patch_size, j:j + patch_size])
+            image_names.append(name)
+
+    # image sizes are needed to plan the evaluation
+    if sizes is None:
+        sizes = image_sizes([target_files[name] for name in image_names])
+    else:
+        sizes = [tuple(sizes[name]) for name in image_names]
+
+    # values of PSNR and MS-SSIM of individual images are cached
+    cache_metrics = bool(cache_dir) and settings.get('cache_metrics', True) and \
+        ('PSNR' in metrics or 'MSSSIM' in metrics) and wait is None
+
+    # content hashes of the targets identify cached data and checkpointed results
+    target_hashes = None
+    if checkpoint_dir or cache_dir and (settings.get('cache_targets', False) or 'KID' in metrics
+            or 'FID' in metrics or cache_metrics):
+        with stage('hash_targets'):
+            target_hashes = list(zip(image_names, parallel_map(
+                hash_file,
+                [target_files[name] for name in image_names],
+                num_workers=num_workers,
+                executor='thread')))
+
+    # targets are either decoded from PNG files or read from a cache of decoded images
+    targets = [target_files[name] for name in image_names]
+    if cache_dir and target_hashes and settings.get('cache_targets', False):
+        data_file = cache_path(cache_dir, 'targets', cache_key(target_hashes), fetch=fetch_cache)
+        # the index of the decoded targets is stored next to them
+        cache_path(cache_dir, 'targets', cache_key(target_hashes), '.json', fetch=fetch_cache)
+        if not os.path.exists(data_file) and logger:
+            logger.info('Caching decoded targets')
+        with stage('cache_targets'):
+            cached = cached_images(
+                image_names, targets, sizes, data_file, num_workers=num_workers, executor=executor)
+        targets = [cached[name] for name in image_names]
+
+    if 'KID' in metrics or 'FID' in metrics:
+        # sample patch locations upfront so that results do not depend on the order in which
+        # images are processed by the workers
+        seed = 0
+        locations = patch_locations(sizes, patch_size, np.random.RandomState(seed))
+
+        # Inception codes of target patches only depend on the targets, the patch locations and
+        # the model
+        target_codes_file = None
+        if target_hashes:
+            target_codes_file = cache_path(
+                cache_dir,
+                'inception_codes',
+                cache_key(target_hashes, patch_size, seed, mmd.inception_version()),
+                fetch=fetch_cache)
+        target_codes_cached = bool(target_codes_file) and os.path.exists(target_codes_file)
+        if target_codes_cached and logger:
+            logger.info('Using cached Inception codes of targets')
+    else:
+        locations = [None] * len(image_names)
+        target_codes_file = None
+        target_codes_cached = False
+
+    def submission_file(name):
+        return wait(name) if wait else submission_files[name]
+
+    # content hashes of submitted images identify cached data and checkpointed results, submitted
+    # images which are still being created are hashed once they are needed
+    submission_hashes = [None] * len(image_names)
+    if (cache_metrics or checkpoint_dir) and wait is None:
+        with stage('hash_submission'):
+            submission_hashes = list(parallel_map(
+                hash_file,
+                [submission_files[name] for name in image_names],
+                num_workers=num_workers,
+                executor='thread'))
+
+    def content_key(k):
+        # identifies the contents of a pair of images
+        if submission_hashes[k] is None:
+            path = submission_file(image_names[k])
+            if path is None:
+                return None
+            submission_hashes[k] = hash_file(path)
+        return cache_key(target_hashes[k][1], submission_hashes[k])
+
+    # results of images evaluated by a previous, interrupted evaluation
+    image_results = [None] * len(image_names)
+    checkpoint_key = cache_key(image_names, sizes, options)
+    if checkpoint_dir:
+        restored = load_checkpoint(checkpoint_dir, checkpoint_key)
+        num_restored = 0
+        for k, name in enumerate(image_names):
+            # results are only reused if neither the target nor the submitted image changed
+            if name in restored and restored[name].pop('content_key') == content_key(k):
+                image_results[k] = restored[name]
+                num_restored += 1
+        if num_restored and logger:
+            logger.info(f'Resuming evaluation after {num_restored} images')
+
+    bytes_per_value = MSSSIM_BYTES_PER_VALUE[options['msssim_backend']]
+
+    def tiled(size):
+        # images whose evaluation would exceed the memory limit are processed in tiles
+        if options['tile_memory'] is None:
+            return False
+        return bytes_per_value * size[0] * size[1] * 3 > options['tile_memory'] * 1e6
+
+    if cache_metrics:
+        # cached values are identified by the contents of both images and the metric's parameters
+        metric_keys = [
+            metric_cache_keys(target_hash, submission_hash, options, tiled(size))
+            for (_, target_hash), submission_hash, size in zip(
+                target_hashes, submission_hashes, sizes)]
+
+        # images are only evaluated if some of their values are missing or patches are needed
+        cached_values = load_image_metrics(cache_dir)
+        num_cached = 0
+        for k, keys in enumerate(metric_keys):
+            if image_results[k] is None and locations[k] is None and \
+                    all(key in cached_values for key in keys.values()):
+                image_results[k] = {'num_dims': sizes[k][0] * sizes[k][1] * 3, 'patches': None}
+                for field, key in keys.items():
+                    image_results[k][field] = cached_values[key]
+                num_cached += 1
+        if num_cached and logger:
+            logger.info(f'Using cached metrics of {num_cached} images')
+
+    pending = [k for k, result in enumerate(image_results) if result is None]
+
+    if 'MSSSIM' in metrics:
+        # images of the same size are scored together, as long as the batch fits into memory
+        max_memory = settings.get('msssim_memory', 512) * 1e6
+
+        def max_batch_size(size):
+            if tiled(size):
+                return 1
+            return int(max_memory // (bytes_per_value * size[0] * size[1] * 3))
+
+        batches = [[pending[i] for i in batch]
+            for batch in group_images([sizes[k] for k in pending], max_batch_size)]
+    else:
+        batches = [[k] for k in pending]
+
+    # jobs are created as they are needed, so that images can be waited for
+    jobs = ((
+        [(targets[k], submission_file(image_names[k]), locations[k]) for k in batch],
+        sizes[batch[0]],
+        tiled(sizes[batch[0]]),
+        options) for batch in batches)
+
+    if num_workers <= 1 and prefetch_depth > 0:
+        # decode upcoming images on other threads while the current images are scored
+        jobs, prefetched_jobs = tee(jobs)
+        decoded = prefetch(
+            _load_batch,
+            prefetched_jobs,
+            depth=prefetch_depth,
+            max_bytes=prefetch_memory,
+            nbytes=_decoded_size)
+        batch_results = (_score_batch(job, *loaded) for job, loaded in zip(jobs, decoded))
+    else:
+        batch_results = parallel_map(_evaluate_batch, jobs, num_workers=num_workers, executor=executor)
+
+    # images evaluated since the last checkpoint
+    checkpoint_indices = []
+    checkpoint_interval = settings.get('checkpoint_interval', 300)
+    checkpoint_time = time.time()
+
+    def checkpoint():
+        save_checkpoint(
+            checkpoint_dir,
+            checkpoint_key,
+            [image_names[k] for k in checkpoint_indices],
+            [image_results[k] for k in checkpoint_indices],
+            [content_key(k) for k in checkpoint_indices])
+        if on_checkpoint:
+            on_checkpoint(checkpoint_dir)
+        checkpoint_indices.clear()
+
+    # partial sums are reduced in the order of the images, independent of how they were batched
+    with stage('images'):
+        for batch, results_of_batch in zip(batches, batch_results):
+            for k, result in zip(batch, results_of_batch):
+                image_results[k] = result
+            checkpoint_indices.extend(batch)
+
+            if checkpoint_dir and time.time() - checkpoint_time > checkpoint_interval:
+                checkpoint()
+                checkpoint_time = time.time()
+
+    if timer:
+        # time spent decoding images and computing each metric, summed across workers
+        seconds = {}
+        for k in pending:
+            for name, value in image_results[k]['seconds'].items():
+                seconds[name] = seconds.get(name, 0.) + value
+        for name, value in seconds.items():
+            timer.add(f'images/{name}', value, num_images=len(pending))
+
+    if checkpoint_dir and checkpoint_indices:
+        # keep results of remaining images in case later steps fail
+        checkpoint()
+
+    if cache_metrics:
+        # values of this evaluation are stored as the most recently used values
+        save_image_metrics(cache_dir, cached_values, {
+            key: float(image_results[k][field])
+            for k, keys in enumerate(metric_keys)
+            for field, key in keys.items()},
+            max_size=settings.get('metrics_cache_size', 200000))
+
+    for file_idx, (name, result) in enumerate(zip(image_names, image_results)):
+        if logger:
+            logger.debug(f'Metrics for image number `{file_idx}` of `{len(image_names)}`: `{name}`')
+
+        num_dims += result['num_dims']
+
+        if 'PSNR' in metrics:
+            sqerror_values.append(result['sqerror'])
+        if 'MSSSIM' in metrics:
+            value = result['msssim']
+            if np.isnan(value):
+                value = 0.0
+                if logger:
+                    logger.warning(
+                            f'Evaluation of MSSSIM for `{name}` returned NaN. Assuming MSSSIM is zero.')
+            msssim_values.append(value)
+        if result['patches'] is not None:
+            if not target_codes_cached:
+                target_patches.append(result['patches'][0])
+            submission_patches.append(result['patches'][1])
 
     results = {}
 
@@ -82,24 +346,597 @@ def evaluate(submission_files, target_files, settings={}, logger=None):
         results['PSNR'] = mse2psnr(np.sum(sqerror_values) / num_dims)
     if 'MSSSIM' in metrics:
         results['MSSSIM'] = np.sum(msssim_values) / num_dims
+    if 'FID' in metrics or 'KID' in metrics:
+        with stage('inception'):
+            features0, features1 = inception_features(
+                target_patches, submission_patches, target_codes_file)
     if 'FID' in metrics:
-        results['FID'] = fid(target_patches, submission_patches)
+        with stage('FID'):
+            results['FID'] = fid(features0, features1)
+    if 'KID' in metrics:
+        with stage('KID'):
+            results['KID'] = kid(
+                features0,
+                features1,
+                n_subsets=settings.get('kid_subsets', 100),
+                subset_size=settings.get('kid_subset_size', 1000),
+                max_memory=settings.get('kid_memory', 0) * 1e6)
     if 'accuracy' in metrics:
         results['accuracy'] = np.mean(accuracy_values)
 
     return results
 
 
-def fid(images0, images1):
+def save_checkpoint(checkpoint_dir, key, names, results, content_keys):
+    """
+    Stores results of images in a new file of a checkpoint directory.
+
+    Parameters
+    ----------
+    checkpoint_dir : str
+        Directory containing checkpoint files
+
+    key : str
+        Identifies the evaluation the results belong to
+
+    names : list[str]
+        Names of images
+
+    results : list[dict]
+        Results of images as computed by `_score_batch`
+
+    content_keys : list[str]
+        Identify the contents of the target and submitted image of each result
+    """
+
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    data = {
+        'key': np.array(key),
+        'names': np.array(names),
+        'content_keys': np.array([content_key or '' for content_key in content_keys]),
+        'num_dims': np.array([result['num_dims'] for result in results], dtype=np.int64),
+    }
+    for metric in ['sqerror', 'msssim']:
+        if results and metric in results[0]:
+            data[metric] = np.array([result[metric] for result in results], dtype=np.float64)
+
+    # patches only take integer values and are stored as 8-bit images
+    with_patches = [k for k, result in enumerate(results) if result['patches'] is not None]
+    if with_patches:
+        data['with_patches'] = np.array(with_patches, dtype=np.int64)
+        data['patches0'] = np.array([results[k]['patches'][0] for k in with_patches], np.uint8)
+        data['patches1'] = np.array([results[k]['patches'][1] for k in with_patches], np.uint8)
+
+    # files are numbered consecutively
+    indices = [
+        int(os.path.basename(path)[:-4]) for path in glob(os.path.join(checkpoint_dir, '*.npz'))]
+    checkpoint_file = os.path.join(checkpoint_dir, '{:05d}.npz'.format(max(indices, default=-1) + 1))
+    with open(checkpoint_file + '.tmp', 'wb') as handle:
+        np.savez(handle, **data)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+def load_checkpoint(checkpoint_dir, key):
+    """
+    Loads results of images stored by `save_checkpoint`. Files belonging to other evaluations, as
+    identified by `key`, are ignored.
+
+    Returns
+    -------
+    dict
+        Maps names of images to their results, including the `content_key` of the images
+    """
+
+    results = {}
+
+    for checkpoint_file in sorted(glob(os.path.join(checkpoint_dir, '*.npz'))):
+        try:
+            data = np.load(checkpoint_file)
+        except (IOError, ValueError):
+            continue
+
+        with data:
+            if str(data['key']) != key:
+                continue
+
+            names = data['names'].tolist()
+            # results of older checkpoints cannot be verified and are not used
+            content_keys = [''] * len(names)
+            if 'content_keys' in data:
+                content_keys = data['content_keys'].tolist()
+            for k, name in enumerate(names):
+                results[name] = {
+                    'num_dims': int(data['num_dims'][k]),
+                    'patches': None,
+                    'content_key': content_keys[k] or None,
+                }
+                for metric in ['sqerror', 'msssim']:
+                    if metric in data:
+                        results[name][metric] = data[metric][k]
+
+            if 'with_patches' in data:
+                patches0 = data['patches0'].astype(np.float32)
+                patches1 = data['patches1'].astype(np.float32)
+                for i, k in enumerate(data['with_patches']):
+                    results[names[k]]['patches'] = (patches0[i], patches1[i])
+
+    return results
+
+
+def metric_cache_keys(target_hash, submission_hash, options, tiled=False):
+    """
+    Computes keys identifying cached values of metrics of a pair of images.
+
+    Returns
+    -------
+    dict
+        Maps names of partial sums computed by `_score_batch` to keys
+    """
+
+    keys = {}
+    if 'PSNR' in options['metrics']:
+        keys['sqerror'] = cache_key(target_hash, submission_hash, 'PSNR')
+    if 'MSSSIM' in options['metrics']:
+        # tiled evaluation and the backends only agree up to numerical precision
+        params = {
+            'backend': 'tiled' if tiled else options['msssim_backend'],
+            'tile_memory': options['tile_memory'] if tiled else None,
+        }
+        keys['msssim'] = cache_key(target_hash, submission_hash, 'MSSSIM', params)
+    return keys
+
+
+def load_image_metrics(cache_dir):
+    """
+    Loads cached values of metrics of individual images.
+
+    Returns
+    -------
+    dict
+        Maps keys computed by `metric_cache_keys` to values, ordered from the least to the most
+        recently used value
+    """
+
+    values = {}
+
+    # older versions stored values of each evaluation in a separate file
+    file_names = sorted(glob(os.path.join(cache_dir, 'image_metrics_*.json')))
+
+    for file_name in file_names + [os.path.join(cache_dir, IMAGE_METRICS_NAME)]:
+        try:
+            with open(file_name) as handle:
+                values.update(json.load(handle))
+        except (IOError, ValueError):
+            continue
+    return values
+
+
+def save_image_metrics(cache_dir, cached_values, values, max_size=200000):
+    """
+    Stores values of metrics of individual images in a single file per phase.
+
+    Concurrent evaluations of a phase may overwrite each other's values, which only means that
+    some values are computed again. Files of older versions are merged into the file and removed.
+
+    Parameters
+    ----------
+    cached_values : dict
+        Values as returned by `load_image_metrics`
+
+    values : dict
+        Values used by the current evaluation, which are marked as the most recently used
+
+    max_size : int
+        Least recently used values are removed so that at most this many values are kept
+    """
+
+    merged = {key: value for key, value in cached_values.items() if key not in values}
+    merged.update(values)
+    if len(merged) > max_size:
+        merged = dict(list(merged.items())[len(merged) - max_size:])
+
+    file_name = os.path.join(cache_dir, IMAGE_METRICS_NAME)
+    with open(file_name + '.tmp', 'w') as handle:
+        json.dump(merged, handle)
+    os.replace(file_name + '.tmp', file_name)
+
+    for file_name in glob(os.path.join(cache_dir, 'image_metrics_*.json')):
+        os.remove(file_name)
+
+
+def parse_settings(settings):
+    """
+    Returns the settings of a phase as a dictionary. Settings which cannot be parsed are ignored.
+    """
+
+    if settings is None:
+        return {}
+    if isinstance(settings, str):
+        try:
+            return json.loads(settings)
+        except json.JSONDecodeError:
+            return {}
+    return settings
+
+
+def _evaluate_batch(job):
+    """
+    Computes metrics for a batch of image pairs of the same size. Runs in worker processes.
+    """
+
+    return _score_batch(job, *_load_batch(job))
+
+
+def _load_batch(job):
+    """
+    Decodes a batch of image pairs and measures how long it takes.
+    """
+
+    start = time.perf_counter()
+    images = _decode_batch(job)
+    return images, time.perf_counter() - start
+
+
+def _decode_batch(job):
+    """
+    Loads a batch of image pairs. Returns two 8-bit arrays of shape
+    `(batch_size, height, width, 3)`.
+    """
+
+    files, size, tiled, options = job
+
+    if len(files) == 1:
+        # avoid copies of images read from a cache
+        target_file, submission_file, _ = files[0]
+        return load_image(target_file)[None], load_image(submission_file)[None]
+
+    images0 = np.empty((len(files),) + size + (3,), dtype=np.uint8)
+    images1 = np.empty_like(images0)
+    for k, (target_file, submission_file, _) in enumerate(files):
+        images0[k] = load_image(target_file)
+        images1[k] = load_image(submission_file)
+
+    return images0, images1
+
+
+def _decoded_size(job):
+    """
+    Number of bytes needed to store the result of `_decode_batch`.
+    """
+
+    files, size, tiled, options = job
+    return len(files) * 2 * size[0] * size[1] * 3
+
+
+def _score_batch(job, images, decode_seconds=0.):
+    """
+    Computes metrics for a batch of decoded image pairs.
+
+    The time spent on decoding and on each metric is split evenly between the images of the batch
+    and stored in their results.
+    """
+
+    files, size, tiled, options = job
+    metrics = options['metrics']
+    patch_size = options['patch_size']
+    images0, images1 = images
+
+    if tiled:
+        result = _score_tiled(images0[0], images1[0], files[0][2], options)
+        result['seconds']['decode'] = decode_seconds
+        return [result]
+
+    results = [{'num_dims': images0[0].size, 'patches': None} for _ in files]
+    seconds = {'decode': decode_seconds}
+
+    if 'PSNR' in metrics:
+        start = time.perf_counter()
+        for k, result in enumerate(results):
+            result['sqerror'] = mse(images1[k], images0[k])
+        seconds['PSNR'] = time.perf_counter() - start
+    if 'MSSSIM' in metrics:
+        start = time.perf_counter()
+        values = msssim_batch(images0, images1, options['msssim_backend'])
+        for k, result in enumerate(results):
+            result['msssim'] = values[k] * images0[k].size
+        seconds['MSSSIM'] = time.perf_counter() - start
+    for k, (_, _, location) in enumerate(files):
+        if location is not None:
+            # extract patches for later use
+            i, j = location
+            results[k]['patches'] = (
+                images0[k, i:i + patch_size, j:j + patch_size].astype(np.float32),
+                images1[k, i:i + patch_size, j:j + patch_size].astype(np.float32))
+
+    for result in results:
+        result['seconds'] = {stage: value / len(results) for stage, value in seconds.items()}
+
+    return results
+
+
+def _score_tiled(image0, image1, location, options):
+    """
+    Computes metrics for a single large pair of 8-bit images while limiting memory usage.
+    """
+
+    metrics = options['metrics']
+    patch_size = options['patch_size']
+
+    tile_size = max_tile_size(options['tile_memory'], image0.shape[2])
+
+    result = {'num_dims': image0.size, 'patches': None, 'seconds': {}}
+
+    if 'PSNR' in metrics:
+        start = time.perf_counter()
+        result['sqerror'] = mse(image1, image0, chunk_size=tile_size)
+        result['seconds']['PSNR'] = time.perf_counter() - start
+    if 'MSSSIM' in metrics:
+        start = time.perf_counter()
+        result['msssim'] = MultiScaleSSIMTiled(
+            image0[None], image1[None], tile_size=tile_size) * image0.size
+        result['seconds']['MSSSIM'] = time.perf_counter() - start
+    if location is not None:
+        # extract patches for later use
+        i, j = location
+        result['patches'] = (
+            image0[i:i + patch_size, j:j + patch_size].astype(np.float32),
+            image1[i:i + patch_size, j:j + patch_size].astype(np.float32))
+
+    return result
+
+
+def max_tile_size(tile_memory, num_channels=3):
+    """
+    Number of rows and columns of a tile such that intermediate results of tiled MS-SSIM fit
+    into `tile_memory` megabytes.
+    """
+
+    tile_size = int(np.sqrt(tile_memory * 1e6 / MSSSIM_BYTES_PER_VALUE['fast'] / num_channels))
+    return max(16, tile_size - 10)
+
+
+def load_image(source):
+    """
+    Loads an 8-bit RGB image from a file or from a cache of decoded images.
+
+    Parameters
+    ----------
+    source : str or tuple
+        Path to an image file, or a tuple of the form `(data_file, offset, shape)` created by
+        `cached_images`
+
+    Returns
+    -------
+    ndarray
+        An array of shape `(height, width, 3)`
+    """
+
+    if isinstance(source, tuple):
+        data_file, offset, shape = source
+        if data_file not in _memmaps:
+            _memmaps[data_file] = np.load(data_file, mmap_mode='r')
+        return _memmaps[data_file][offset:offset + int(np.prod(shape))].reshape(shape)
+    return np.asarray(Image.open(source).convert('RGB'))
+
+
+# memory-mapped caches opened by this process
+_memmaps = {}
+
+
+def cached_images(names, files, sizes, data_file, num_workers=1, executor='process'):
+    """
+    Returns the locations of decoded images in a memory-mapped cache, creating the cache first
+    if it does not exist yet.
+
+    The cache consists of a flat array of 8-bit pixels and an index storing the names, shapes
+    and offsets of the images.
+
+    Returns
+    -------
+    dict
+        Maps names to tuples of the form `(data_file, offset, shape)`
+    """
+
+    index_file = os.path.splitext(data_file)[0] + '.json'
+
+    if not (os.path.exists(data_file) and os.path.exists(index_file)):
+        shapes = [size + (3,) for size in sizes]
+        offsets = np.cumsum([0] + [int(np.prod(shape)) for shape in shapes]).tolist()
+
+        # write to temporary files first so that incomplete caches are never used
+        tmp_file = data_file + '.tmp'
+        np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=(offsets[-1],))
+        jobs = [(file, tmp_file, offset) for file, offset in zip(files, offsets)]
+        for _ in parallel_map(_cache_image, jobs, num_workers=num_workers, executor=executor):
+            pass
+        os.replace(tmp_file, data_file)
+
+        with open(index_file + '.tmp', 'w') as handle:
+            json.dump({'names': names, 'shapes': shapes, 'offsets': offsets[:-1]}, handle)
+        os.replace(index_file + '.tmp', index_file)
+
+    with open(index_file) as handle:
+        index = json.load(handle)
+
+    return {
+        name: (data_file, offset, tuple(shape))
+        for name, offset, shape in zip(index['names'], index['offsets'], index['shapes'])}
+
+
+def _cache_image(job):
+    """
+    Decodes an image and writes it into a memory-mapped cache. Runs in worker processes.
+    """
+
+    file, data_file, offset = job
+    image = load_image(file)
+    data = np.load(data_file, mmap_mode='r+')
+    data[offset:offset + image.size] = image.ravel()
+    data.flush()
+
+
+def image_sizes(files):
+    """
+    Returns the height and width of each image. Only image headers are read.
+    """
+
+    return [image_size(file) for file in files]
+
+
+def image_size(file):
+    """
+    Returns the height and width of an image. For PNG files, only the first 24 bytes are read.
+    """
+
+    with open(file, 'rb') as handle:
+        header = handle.read(24)
+
+    if header[:8] == PNG_SIGNATURE and header[12:16] == b'IHDR':
+        width, height = struct.unpack('>II', header[16:24])
+    else:
+        with Image.open(file) as image:
+            width, height = image.size
+    return height, width
+
+
+def patch_locations(sizes, patch_size, rs):
+    """
+    Samples the location of a random patch for each image. Images smaller than the patch size
+    are assigned a location of `None`.
+    """
+
+    locations = []
+    for height, width in sizes:
+        if height >= patch_size and width >= patch_size:
+            i = rs.randint(height - patch_size + 1)
+            j = rs.randint(width - patch_size + 1)
+            locations.append((i, j))
+        else:
+            locations.append(None)
+    return locations
+
+
+def group_images(sizes, max_batch_size):
+    """
+    Groups indices of images of the same size into batches.
+
+    Parameters
+    ----------
+    sizes : list[tuple]
+        Size of each image
+
+    max_batch_size : callable
+        Maps an image size to the maximum number of images in a batch
+
+    Returns
+    -------
+    list[list[int]]
+        Indices of images in each batch
+    """
+
+    groups = {}
+    for k, size in enumerate(sizes):
+        groups.setdefault(size, []).append(k)
+
+    batches = []
+    for size, indices in groups.items():
+        batch_size = max(1, max_batch_size(size))
+        for start in range(0, len(indices), batch_size):
+            batches.append(indices[start:start + batch_size])
+    return batches
+
+
+def prefetch(func, items, depth=2, max_bytes=None, nbytes=None):
+    """
+    Applies a function to each item on a pool of threads, returning results in the order of the
+    items.
+
+    Results are computed for up to `depth` items ahead of the consumer. If `max_bytes` is given,
+    fewer items are processed ahead of time if their results, whose size is estimated by
+    `nbytes(item)`, would otherwise exceed this number of bytes.
+    """
+
+    # items are only requested when there is room for them, so that they can be produced lazily
+    end, missing = object(), object()
+    items = iter(items)
+    item = missing
+    pending = deque()
+    pending_bytes = 0
+
+    with ThreadPoolExecutor(max_workers=depth) as pool:
+        while True:
+            while len(pending) < depth:
+                if item is missing:
+                    item = next(items, end)
+                if item is end:
+                    break
+                item_bytes = nbytes(item) if nbytes else 0
+                if pending and max_bytes is not None and pending_bytes + item_bytes > max_bytes:
+                    break
+                pending.append((pool.submit(func, item), item_bytes))
+                pending_bytes += item_bytes
+                item = missing
+
+            if not pending:
+                break
+
+            future, item_bytes = pending.popleft()
+            pending_bytes -= item_bytes
+            yield future.result()
+
+
+def parallel_map(func, iterable, num_workers=1, executor='process'):
+    """
+    Applies a function to each item, returning results in the order of the items.
+
+    If `num_workers` is larger than 1, items are processed by a pool of processes or threads,
+    depending on `executor`.
+    """
+
+    if num_workers <= 1:
+        yield from map(func, iterable)
+        return
+
+    if executor == 'process':
+        pool = ProcessPoolExecutor(max_workers=num_workers)
+    elif executor == 'thread':
+        pool = ThreadPoolExecutor(max_workers=num_workers)
+    else:
+        raise ValueError(f'Unknown executor `{executor}`')
+
+    # only a limited number of items is submitted ahead of time, so that items can be produced
+    # lazily and results are returned as soon as they are ready
+    with pool:
+        pending = deque()
+        for item in iterable:
+            if len(pending) >= 2 * num_workers:
+                yield pending.popleft().result()
+            pending.append(pool.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+
+
+def inception_features(images0, images1, cache_file=None):
+    """
+    Computes Inception codes of two sets of images. If `cache_file` is given, codes of the first
+    set of images are loaded from or stored in this file.
+    """
+
     with open(os.devnull, 'w') as devnull:
         kwargs = {
                 'get_codes': True,
                 'get_preds': False,
                 'batch_size': 100,
                 'output': devnull}
-        model = mmd.Inception()
-        features0 = mmd.featurize(images0, model, **kwargs)[-1]
+        model = mmd.get_inception()
+        features0 = inception_codes(images0, model, cache_file, **kwargs)
         features1 = mmd.featurize(images1, model, **kwargs)[-1]
+    return features0, features1
+
+
+def fid(features0, features1):
+    with open(os.devnull, 'w') as devnull:
         # average across splits
         score = np.mean(
                 mmd.fid_score(
@@ -111,35 +948,130 @@ def fid(images0, images1):
     return score
 
 
-def mse(image0, image1):
+def kid(features0, features1, n_subsets=100, subset_size=1000, max_memory=0):
+    num_samples = min(len(features0), len(features1))
+    if num_samples < 2:
+        return np.nan
+    with open(os.devnull, 'w') as devnull:
+        # average across subsets
+        score = np.mean(
+                mmd.polynomial_mmd_averages(
+                        features1,
+                        features0,
+                        n_subsets=n_subsets,
+                        subset_size=min(subset_size, num_samples),
+                        ret_var=False,
+                        output=devnull,
+                        max_kernel_memory=max_memory))
+    return score
+
+
+def inception_codes(images, model, cache_file=None, **kwargs):
+    """
+    Featurizes images, using and updating a memory-mapped cache if `cache_file` is given.
+    """
+
+    if not cache_file:
+        return mmd.featurize(images, model, **kwargs)[-1]
+
+    if not os.path.exists(cache_file):
+        # write to a temporary file first so that incomplete caches are never used
+        tmp_file = cache_file + '.tmp'
+        codes = np.lib.format.open_memmap(
+            tmp_file, mode='w+', dtype=np.float32, shape=(len(images), model.coder_dim))
+        mmd.featurize(images, model, out_codes=codes, **kwargs)
+        codes.flush()
+        del codes
+        os.replace(tmp_file, cache_file)
+
+    return np.load(cache_file, mmap_mode='r')
+
+
+def mse(image0, image1, chunk_size=None):
+    """
+    Computes the sum of squared errors.
+
+    For 8-bit and 16-bit images, the sum is computed exactly using integer arithmetic, a few rows
+    at a time. Other images are converted to float64, `chunk_size` rows at a time if given.
+    """
+
+    if image0.dtype in INTEGER_DTYPES and image1.dtype in INTEGER_DTYPES:
+        return _sqerror_integer(image0, image1, chunk_size)
+    if chunk_size is not None:
+        return sum(
+            mse(image0[i:i + chunk_size], image1[i:i + chunk_size])
+            for i in range(0, image0.shape[0], chunk_size))
     return np.sum(np.square(image1.astype(np.float64) - image0.astype(np.float64)))
 
 
-def mse2psnr(mse):
-    mse = mse.astype(np.float64)
-    return 20. * np.log10(255.) - 10. * np.log10(mse)
+def _sqerror_integer(image0, image1, chunk_size=None):
+    """
+    Computes the sum of squared errors of 8-bit or 16-bit images without creating floating
+    point copies.
+    """
+
+    # squared differences of 8-bit values fit into 32 bits
+    dtype = np.int32 if image0.itemsize == image1.itemsize == 1 else np.int64
+
+    if chunk_size is None:
+        # process about a million values at a time
+        chunk_size = max(1, (1 << 20) // max(1, image0[:1].size))
+
+    sqerror = 0
+    for i in range(0, image0.shape[0], chunk_size):
+        diff = np.subtract(image1[i:i + chunk_size], image0[i:i + chunk_size], dtype=dtype)
+        np.multiply(diff, diff, out=diff)
+        sqerror += int(np.sum(diff, dtype=np.int64))
+    return sqerror
+
 
+def mse2psnr(mse, max_val=255.):
+    mse = np.float64(mse)
+    return 20. * np.log10(max_val) - 10. * np.log10(mse)
 
-def msssim(image0, image1):
-    return MultiScaleSSIM(image0[None], image1[None])
+
+def msssim(image0, image1, backend='reference', max_val=255):
+    return MSSSIM_BACKENDS[backend](image0[None], image1[None], max_val=max_val)
+
+
+def msssim_batch(images0, images1, backend='reference'):
+    return MSSSIM_BACKENDS[backend](images0, images1, per_image=True)
 
 
 def accuracy(file0, file1, logger=None):
-    matches = 0.
-    nonmatches = 0.
-    for k in file0.keys():
-        if k not in file1:
-            if logger:
-                logger.error(f'Missing key {k}')
-            return None
-        if file0[k] == file1[k]:
-            matches += 1
-        else:
-            nonmatches += 1
-    return matches / float(matches + nonmatches)
+    """
+    Computes the fraction of scores in `file1` which agree with the scores in `file0`.
+
+    Both files are given as returned by `read_csv`. Since keys are sorted, the scores of the
+    submission are looked up all at once using a binary search.
+
+    Returns `None` if `file1` is missing any keys of `file0` or if `file0` is empty.
+    """
+
+    if len(file0) == 0:
+        if logger:
+            logger.error('No scores to compare')
+        return None
 
+    if len(file1):
+        indices = np.minimum(np.searchsorted(file1['key'], file0['key']), len(file1) - 1)
+        found = file1['key'][indices] == file0['key']
+    else:
+        indices = np.zeros(len(file0), dtype=np.int64)
+        found = np.zeros(len(file0), dtype=bool)
 
-def read_csv(file_name, logger=None):
+    if not np.all(found):
+        if logger:
+            missing = file0['key'][~found].tolist()
+            logger.error('Missing {num_missing} keys: {keys}'.format(
+                num_missing=len(missing),
+                keys=', '.join(missing[:10]) + (', ...' if len(missing) > 10 else '')))
+        return None
+
+    return np.mean(file0['score'] == file1['score'][indices])
+
+
+def read_csv(file_name, logger=None, cache_dir=None, fetch_cache=None):
     """Read CSV file.
 
     The CSV file contains 4 columns:
@@ -150,21 +1082,65 @@ def read_csv(file_name, logger=None):
     BinaryScore: 0/1. This should be 0 if FileA is closer to the original than
     FileB.
 
+    Empty lines are ignored.
+
     Args:
             file_name: file name to read.
+            logger: used to report malformed files.
+            cache_dir: if given, parsed contents are cached here.
+            fetch_cache: called with the path of the cached file if it is missing.
 
     Returns:
-            dict({a/b/c} -> score).
+            structured array with string fields `key` ({a/b/c}) and `score`,
+            sorted by key, or None if the file is malformed.
     """
-    contents = {}
+    cache_file = None
+    if cache_dir:
+        cache_file = cache_path(
+            cache_dir, 'csv', cache_key(hash_file(file_name)), fetch=fetch_cache)
+        if os.path.exists(cache_file):
+            return np.load(cache_file)
+
     with open(file_name) as csvfile:
-        reader = csv.reader(csvfile)
+        content = csvfile.read()
 
-        for row in reader:
-            if len(row) != 4:
-                if logger:
-                    logger.error('Expected CSV file to contain 4 columns. Found %d.', len(row))
-                return None
+    if '"' in content:
+        # quoted fields need to be parsed by the CSV module
+        rows = [row for row in csv.reader(io.StringIO(content)) if row]
+        num_columns = set(map(len, rows)) - {4}
+    else:
+        # split all lines at once, the key being everything before the last comma
+        lines = np.array([line for line in content.splitlines() if line], dtype=str)
+        num_columns = set((np.char.count(lines, ',') + 1).tolist()) - {4}
+
+    if num_columns:
+        if logger:
+            logger.error('Expected CSV file to contain 4 columns. Found %d.', min(num_columns))
+        return None
+
+    if '"' in content:
+        table = np.array(rows, dtype=str).reshape(-1, 4)
+        keys = np.char.add(np.char.add(np.char.add(np.char.add(
+            table[:, 0], ','), table[:, 1]), ','), table[:, 2])
+        scores = table[:, 3]
+    elif len(lines):
+        columns = np.char.rpartition(lines, ',').reshape(-1, 3)
+        keys = columns[:, 0]
+        scores = columns[:, 2]
+    else:
+        keys = scores = np.array([], dtype=str)
+
+    # later rows replace earlier rows with the same key
+    keys, indices = np.unique(keys[::-1], return_index=True)
+    scores = scores[::-1][indices]
+
+    contents = np.empty(len(keys), dtype=[('key', keys.dtype), ('score', scores.dtype)])
+    contents['key'] = keys
+    contents['score'] = scores
+
+    if cache_file:
+        with open(cache_file + '.tmp', 'wb') as handle:
+            np.save(handle, contents)
+        os.replace(cache_file + '.tmp', cache_file)
 
-            contents[','.join(row[:3])] = row[3]
     return contents
@@ -36,10 +36,11 @@ from __future__ import division, print_function
 
 import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import hashlib
 import os.path, sys, tarfile
 import numpy as np
 from scipy import linalg
-from six.moves import range, urllib
+from six.moves import range
 from sklearn.metrics.pairwise import polynomial_kernel
 import tensorflow as tf
 from tqdm import tqdm
@@ -53,44 +54,55 @@ class TqdmUpTo(tqdm):
         self.update(b * bsize - self.n)  # also sets self.n = b * bsize
 
 
+# location of the Inception model, which can be overwritten with INCEPTION_MODEL_DIR
+INCEPTION_MODEL_DIR = '/tmp/imagenet'
+INCEPTION_DATA_URL = 'http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz'
+INCEPTION_GRAPH_FILE = 'classify_image_graph_def.pb'
+
+
 class Inception(object):
-    def __init__(self):
-        MODEL_DIR = '/tmp/imagenet'
-        DATA_URL = ('http://download.tensorflow.org/models/image/imagenet/inception-2015-12-05.tgz')
+    def __init__(self, model_dir=None):
+        """
+        Loads the frozen Inception graph from `model_dir`. The model is never downloaded, but
+        the archive at `INCEPTION_DATA_URL` is extracted if only the archive is present.
+        """
+        if model_dir is None:
+            model_dir = os.environ.get('INCEPTION_MODEL_DIR', INCEPTION_MODEL_DIR)
         self.softmax_dim = 1008
         self.coder_dim = 2048
 
-        if not os.path.exists(MODEL_DIR):
-            os.makedirs(MODEL_DIR)
-        filename = DATA_URL.split('/')[-1]
-        filepath = os.path.join(MODEL_DIR, filename)
-
-        if not os.path.exists(filepath):
-            filepath, _ = urllib.request.urlretrieve(DATA_URL, filepath)
-
-        tarfile.open(filepath, 'r:gz').extractall(MODEL_DIR)
-        with tf.io.gfile.GFile(os.path.join(
-                MODEL_DIR, 'classify_image_graph_def.pb'), 'rb') as f:
-            graph_def = tf.compat.v1.GraphDef()
-            graph_def.ParseFromString(f.read())
-            tf.import_graph_def(graph_def, name='')
-
-        # Works with an arbitrary minibatch size.
-        self.sess = sess = tf.compat.v1.Session()
-        #with sess:
-        pool3 = sess.graph.get_tensor_by_name('pool_3:0')
-        ops = pool3.graph.get_operations()
-        for op_idx, op in enumerate(ops):
-            for o in op.outputs:
-                shape = [s.value for s in o.get_shape()]
-                if len(shape) and shape[0] == 1:
-                    shape[0] = None
-                o.__dict__['_shape_val'] = tf.TensorShape(shape)
-        w = sess.graph.get_operation_by_name(
-            "softmax/logits/MatMul").inputs[1]
-        self.coder = tf.squeeze(tf.squeeze(pool3, 2), 1)
-        logits = tf.matmul(self.coder, w)
-        self.softmax = tf.nn.softmax(logits)
+        graph_path = os.path.join(model_dir, INCEPTION_GRAPH_FILE)
+        if not os.path.exists(graph_path):
+            filepath = os.path.join(model_dir, INCEPTION_DATA_URL.split('/')[-1])
+            if not os.path.exists(filepath):
+                raise IOError('Could not find Inception model in {}. Download {} and extract '
+                    'it into this directory.'.format(model_dir, INCEPTION_DATA_URL))
+            tarfile.open(filepath, 'r:gz').extractall(model_dir)
+
+        # use a separate graph so that multiple models do not interfere
+        graph = tf.Graph()
+        with graph.as_default():
+            with tf.io.gfile.GFile(graph_path, 'rb') as f:
+                graph_def = tf.compat.v1.GraphDef()
+                graph_def.ParseFromString(f.read())
+                tf.import_graph_def(graph_def, name='')
+
+            # Works with an arbitrary minibatch size.
+            self.sess = sess = tf.compat.v1.Session(graph=graph)
+            #with sess:
+            pool3 = sess.graph.get_tensor_by_name('pool_3:0')
+            ops = pool3.graph.get_operations()
+            for op_idx, op in enumerate(ops):
+                for o in op.outputs:
+                    shape = [s.value for s in o.get_shape()]
+                    if len(shape) and shape[0] == 1:
+                        shape[0] = None
+                    o.__dict__['_shape_val'] = tf.TensorShape(shape)
+            w = sess.graph.get_operation_by_name(
+                "softmax/logits/MatMul").inputs[1]
+            self.coder = tf.squeeze(tf.squeeze(pool3, 2), 1)
+            logits = tf.matmul(self.coder, w)
+            self.softmax = tf.nn.softmax(logits)
 
         assert self.coder.get_shape()[1].value == self.coder_dim
         assert self.softmax.get_shape()[1].value == self.softmax_dim
@@ -98,6 +110,54 @@ class Inception(object):
         self.input = 'ExpandDims:0'
 
 
+_inception_models = {}
+
+
+def get_inception(model_dir=None):
+    """
+    Returns an Inception model shared by the whole process. The model and its session are
+    created on first use and reused afterwards.
+    """
+    if model_dir is None:
+        model_dir = os.environ.get('INCEPTION_MODEL_DIR', INCEPTION_MODEL_DIR)
+    if model_dir not in _inception_models:
+        _inception_models[model_dir] = Inception(model_dir)
+    return _inception_models[model_dir]
+
+
+_inception_versions = {}
+
+
+def inception_version(model_dir=None):
+    """
+    Identifies the Inception model, so that cached codes are not reused after the model changed.
+
+    Returns
+    -------
+    str
+        SHA-224 hash of the frozen graph, or of the archive if it has not been extracted yet
+    """
+    if model_dir is None:
+        model_dir = os.environ.get('INCEPTION_MODEL_DIR', INCEPTION_MODEL_DIR)
+
+    path = os.path.join(model_dir, INCEPTION_GRAPH_FILE)
+    if not os.path.exists(path):
+        path = os.path.join(model_dir, INCEPTION_DATA_URL.split('/')[-1])
+    if not os.path.exists(path):
+        raise IOError('Could not find Inception model in {}.'.format(model_dir))
+
+    # the model is only hashed again if its file changed
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    if key not in _inception_versions:
+        sha224 = hashlib.sha224()
+        with open(path, 'rb') as handle:
+            for chunk in iter(lambda: handle.read(1 << 20), b''):
+                sha224.update(chunk)
+        _inception_versions[key] = sha224.hexdigest()
+    return _inception_versions[key]
+
+
 class LeNet(object):
     def __init__(self):
         MODEL_DIR = 'lenet/saved_model'
@@ -208,52 +268,142 @@ def inception_score(preds, **split_args):
     return scores
 
 
-def fid_score(codes_g, codes_r, eps=1e-6, output=sys.stdout, **split_args):
+def fid_score(codes_g, codes_r, eps=1e-6, output=sys.stdout, method='eigh',
+              **split_args):
+    """
+    Computes the FID for each split. With `method='eigh'`, the trace of the matrix square root
+    is computed from the eigenvalues of a symmetric matrix, and the moments of bootstrap splits
+    are computed from resampling weights. `method='sqrtm'` uses `scipy.linalg.sqrtm` instead.
+    """
     splits_g = get_splits(codes_g.shape[0], **split_args)
     splits_r = get_splits(codes_r.shape[0], **split_args)
     assert len(splits_g) == len(splits_r)
     d = codes_g.shape[1]
     assert codes_r.shape[1] == d
 
+    if method == 'eigh':
+        # center codes once, which keeps the computation of covariances numerically stable
+        offset_g = np.mean(codes_g, axis=0, dtype=np.float64)
+        offset_r = np.mean(codes_r, axis=0, dtype=np.float64)
+        centered_g = np.subtract(codes_g, offset_g, dtype=np.float64)
+        centered_r = np.subtract(codes_r, offset_r, dtype=np.float64)
+    elif method != 'sqrtm':
+        raise ValueError("bad method {}".format(method))
+
     scores = np.zeros(len(splits_g))
     with tqdm(splits_g, desc='FID', file=output) as bar:
         for i, (w_g, w_r) in enumerate(zip(bar, splits_r)):
-            part_g = codes_g[w_g]
-            part_r = codes_r[w_r]
+            if method == 'eigh':
+                mn_g, cov_g = _split_moments(centered_g, w_g)
+                mn_r, cov_r = _split_moments(centered_r, w_r)
+                mn_g += offset_g
+                mn_r += offset_r
+
+                tr_covmean = _trace_sqrt_product(cov_g, cov_r)
+                if not np.isfinite(tr_covmean):
+                    cov_g[range(d), range(d)] += eps
+                    cov_r[range(d), range(d)] += eps
+                    tr_covmean = _trace_sqrt_product(cov_g, cov_r)
+            else:
+                part_g = codes_g[w_g]
+                part_r = codes_r[w_r]
 
-            mn_g = part_g.mean(axis=0)
-            mn_r = part_r.mean(axis=0)
+                mn_g = part_g.mean(axis=0)
+                mn_r = part_r.mean(axis=0)
 
-            cov_g = np.cov(part_g, rowvar=False)
-            cov_r = np.cov(part_r, rowvar=False)
+                cov_g = np.cov(part_g, rowvar=False)
+                cov_r = np.cov(part_r, rowvar=False)
 
-            settings = np.seterr(all='ignore')
-            covmean, _ = linalg.sqrtm(cov_g.dot(cov_r), disp=False)
-            if not np.isfinite(covmean).all():
-                cov_g[range(d), range(d)] += eps
-                cov_r[range(d), range(d)] += eps
-                covmean = linalg.sqrtm(cov_g.dot(cov_r))
-            np.seterr(**settings)
+                settings = np.seterr(all='ignore')
+                covmean, _ = linalg.sqrtm(cov_g.dot(cov_r), disp=False)
+                if not np.isfinite(covmean).all():
+                    cov_g[range(d), range(d)] += eps
+                    cov_r[range(d), range(d)] += eps
+                    covmean = linalg.sqrtm(cov_g.dot(cov_r))
+                np.seterr(**settings)
+                tr_covmean = np.trace(covmean)
 
             scores[i] = np.sum((mn_g - mn_r) ** 2) + (
-                np.trace(cov_g) + np.trace(cov_r) - 2 * np.trace(covmean))
+                np.trace(cov_g) + np.trace(cov_r) - 2 * np.real(tr_covmean))
             bar.set_postfix({'mean': scores[:i+1].mean()})
     return scores
 
 
+def _split_moments(codes, split, block_size=4096):
+    """
+    Computes mean and covariance of `codes[split]` without copying all selected rows.
+
+    Rows are weighted by how often they are selected. For numerical stability, `codes` should
+    be centered.
+    """
+    n = codes.shape[0]
+    weights = np.bincount(np.arange(n)[split], minlength=n).astype(np.float64)
+    rows = np.flatnonzero(weights)
+    num_samples = weights.sum()
+
+    mean = weights.dot(codes) / num_samples
+    cov = np.zeros((codes.shape[1], codes.shape[1]))
+    for start in range(0, rows.size, block_size):
+        block_rows = rows[start:start + block_size]
+        block = codes[block_rows]
+        cov += (block.T * weights[block_rows]).dot(block)
+    cov -= num_samples * np.outer(mean, mean)
+    cov /= num_samples - 1
+    return mean, cov
+
+
+def _trace_sqrt_product(cov_g, cov_r):
+    """
+    Computes the trace of the square root of `cov_g.dot(cov_r)` for two positive
+    semi-definite matrices.
+
+    The product has the same eigenvalues as the symmetric matrix `S.dot(cov_r).dot(S)`, where
+    `S` is the square root of `cov_g`. The trace of the square root is the sum of the square
+    roots of these eigenvalues.
+    """
+    settings = np.seterr(all='ignore')
+    eigvals, eigvecs = linalg.eigh(cov_g)
+    sqrt_cov_g = (eigvecs * np.sqrt(np.maximum(eigvals, 0))).dot(eigvecs.T)
+    eigvals = linalg.eigvalsh(sqrt_cov_g.dot(cov_r).dot(sqrt_cov_g))
+    np.seterr(**settings)
+    return np.sum(np.sqrt(np.maximum(eigvals, 0)))
+
+
 def polynomial_mmd_averages(codes_g, codes_r, n_subsets=50, subset_size=1000,
-                            ret_var=True, output=sys.stdout, **kernel_args):
+                            ret_var=True, output=sys.stdout,
+                            max_kernel_memory=0, **kernel_args):
+    """
+    Estimates MMD on random subsets of the codes.
+
+    If the kernel matrices of all codes fit into `max_kernel_memory` bytes, they
+    are computed once and subsets are selected from them. This is faster when
+    many subsets are drawn, but the three float64 matrices take
+    `8 * (n_g ** 2 + n_g * n_r + n_r ** 2)` bytes, e.g., 600 MB for 5000 codes
+    of each kind.
+    By default, kernel matrices are computed for each subset instead.
+    """
     m = min(codes_g.shape[0], codes_r.shape[0])
     mmds = np.zeros(n_subsets)
     if ret_var:
         vars = np.zeros(n_subsets)
     choice = np.random.choice
 
+    n_g, n_r = codes_g.shape[0], codes_r.shape[0]
+    precompute = 8 * (n_g ** 2 + n_g * n_r + n_r ** 2) <= max_kernel_memory
+    if precompute:
+        K_XX, K_XY, K_YY = _polynomial_kernels(codes_g, codes_r, **kernel_args)
+
     with tqdm(range(n_subsets), desc='MMD', file=output) as bar:
         for i in bar:
-            g = codes_g[choice(len(codes_g), subset_size, replace=False)]
-            r = codes_r[choice(len(codes_r), subset_size, replace=False)]
-            o = polynomial_mmd(g, r, **kernel_args, var_at_m=m, ret_var=ret_var)
+            g = choice(len(codes_g), subset_size, replace=False)
+            r = choice(len(codes_r), subset_size, replace=False)
+            if precompute:
+                o = _mmd2_and_variance(
+                    K_XX[np.ix_(g, g)], K_XY[np.ix_(g, r)], K_YY[np.ix_(r, r)],
+                    var_at_m=m, ret_var=ret_var)
+            else:
+                o = polynomial_mmd(codes_g[g], codes_r[r], **kernel_args,
+                                   var_at_m=m, ret_var=ret_var)
             if ret_var:
                 mmds[i], vars[i] = o
             else:
@@ -264,6 +414,14 @@ def polynomial_mmd_averages(codes_g, codes_r, n_subsets=50, subset_size=1000,
 
 def polynomial_mmd(codes_g, codes_r, degree=3, gamma=None, coef0=1,
                    var_at_m=None, ret_var=True):
+    K_XX, K_XY, K_YY = _polynomial_kernels(
+        codes_g, codes_r, degree=degree, gamma=gamma, coef0=coef0)
+
+    return _mmd2_and_variance(K_XX, K_XY, K_YY,
+                              var_at_m=var_at_m, ret_var=ret_var)
+
+
+def _polynomial_kernels(codes_g, codes_r, degree=3, gamma=None, coef0=1):
     # use  k(x, y) = (gamma <x, y> + coef0)^degree
     # default gamma is 1 / dim
     X = codes_g
@@ -273,8 +431,7 @@ def polynomial_mmd(codes_g, codes_r, degree=3, gamma=None, coef0=1,
     K_YY = polynomial_kernel(Y, degree=degree, gamma=gamma, coef0=coef0)
     K_XY = polynomial_kernel(X, Y, degree=degree, gamma=gamma, coef0=coef0)
 
-    return _mmd2_and_variance(K_XX, K_XY, K_YY,
-                              var_at_m=var_at_m, ret_var=ret_var)
+    return K_XX, K_XY, K_YY
 
 
 def _sqn(arr):
@@ -0,0 +1,151 @@
+"""
+Coordinates decoding and evaluation when both run at the same time.
+
+In pipelined mode, which is enabled by the `pipelined` setting of a phase, the decoder and the
+evaluation share a directory on the host named after the ID of the submission. `decode.py`
+appends completed outputs of the decoder to a manifest and creates marker files once decoding has
+finished and once all files have been uploaded. `evaluate.py` scores outputs as they appear in the
+manifest.
+"""
+
+import os
+import time
+
+MANIFEST_NAME = '.manifest_decode'
+
+# created by decode.py after the decoder finished, successfully or not
+DECODED_NAME = '.decoded'
+
+# created by decode.py after outputs have been copied to the storage bucket
+UPLOADED_NAME = '.uploaded'
+
+
+def mark(directory, name):
+	"""
+	Creates a marker file.
+	"""
+
+	path = os.path.join(directory, name)
+	with open(path + '.tmp', 'w'):
+		pass
+	os.replace(path + '.tmp', path)
+
+
+class DecoderOutputs:
+	"""
+	Tracks outputs of a decoder which is still running.
+
+	Parameters
+	----------
+	directory : str
+		Working directory of the decoder
+
+	failed : callable
+		Called regularly while waiting, should return `True` if decoding stopped without creating
+		a marker, for example, because `decode.py` crashed
+
+	interval : float
+		Number of seconds between checks for new outputs
+
+	check_interval : float
+		Number of seconds between calls to `failed`
+
+	timeout : float
+		Number of seconds after which decoding is treated as finished even if no marker was
+		created, for example, because the decoder's pod was killed before `decode.py` could create
+		it
+	"""
+
+	def __init__(self, directory, failed=None, interval=1., check_interval=30., timeout=None):
+		self.directory = directory
+		self.failed = failed
+		self.interval = interval
+		self.check_interval = check_interval
+		self.timeout = timeout
+
+		# maps names of completed files to their paths
+		self.files = {}
+		self.done = False
+		self.timed_out = False
+
+		self._offset = 0
+		self._check_time = time.time()
+		self._start_time = time.time()
+
+	def refresh(self):
+		"""
+		Reads files newly added to the manifest and checks whether decoding has finished.
+		"""
+
+		# the marker is checked first, so that the manifest is complete if it exists
+		done = self.done or os.path.exists(os.path.join(self.directory, DECODED_NAME))
+
+		try:
+			with open(os.path.join(self.directory, MANIFEST_NAME), 'rb') as handle:
+				handle.seek(self._offset)
+				data = handle.read()
+		except IOError:
+			data = b''
+
+		# only complete lines are used, the decoder may be appending to the file
+		data = data[:data.rfind(b'\n') + 1]
+		self._offset += len(data)
+
+		for line in data.decode().splitlines():
+			path = os.path.join(self.directory, line)
+			self.files[os.path.basename(path)] = path
+
+		if not done and self.failed and time.time() - self._check_time > self.check_interval:
+			self._check_time = time.time()
+			done = self.failed()
+
+		if not done and self.timeout is not None and time.time() - self._start_time > self.timeout:
+			self.timed_out = done = True
+
+		self.done = done
+
+	def wait(self, name):
+		"""
+		Waits until a file has been completed by the decoder.
+
+		Returns
+		-------
+		str
+			Path of the file, or `None` if decoding finished without creating the file
+		"""
+
+		while True:
+			self.refresh()
+			if name in self.files:
+				return self.files[name]
+			if self.done:
+				return None
+			time.sleep(self.interval)
+
+	def wait_done(self):
+		"""
+		Waits until decoding has finished.
+		"""
+
+		while not self.done:
+			self.refresh()
+			if not self.done:
+				time.sleep(self.interval)
+
+
+def wait_for_marker(directory, name, timeout, interval=1.):
+	"""
+	Waits until a marker file exists.
+
+	Returns
+	-------
+	bool
+		`True` if the marker was created within `timeout` seconds
+	"""
+
+	start = time.time()
+	while not os.path.exists(os.path.join(directory, name)):
+		if time.time() - start > timeout:
+			return False
+		time.sleep(interval)
+	return True
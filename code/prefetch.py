@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+"""
+This script keeps the Docker images used by decoders up to date on a node. It runs on every node
+of the cluster and periodically does the following:
+
+	1. Obtain active Docker images from the SQL database
+	2. Pull each image
+	3. Record the ID of each local image together with the time and duration of its pull
+
+`decode.py` skips pulling an image if it has been recently pulled and the image present on the
+node is still the one which was pulled.
+"""
+
+import json
+import os
+import sys
+import time
+import traceback
+from argparse import ArgumentParser
+from http.client import HTTPException
+from docker_client import SOCKET_PATH, DockerClient, DockerError, NotFoundError
+from utils import get_logger, sql_setup
+
+STATE_FILE = '/var/lib/docker/prefetch.json'
+
+
+def main(args):
+	logger = get_logger(debug=args.debug)
+
+	try:
+		logger.debug('Connecting to SQL database')
+		sql_setup()
+	except:
+		logger.error('Unable to connect to SQL database')
+		logger.debug(traceback.format_exc())
+		return 1
+
+	# sql_setup needs to be called before importing anything from Django
+	from models import DockerImage
+	from django.db import connection
+
+	docker = DockerClient(args.docker_socket)
+
+	while True:
+		try:
+			images = DockerImage.objects.filter(active=True)
+			if not args.gpu:
+				# GPU images are only used on nodes with GPUs
+				images = images.filter(gpu=False)
+			names = sorted(set(image.name for image in images))
+		except:
+			logger.error('Unable to obtain Docker images')
+			logger.debug(traceback.format_exc())
+			names = []
+		finally:
+			# avoid keeping a connection open while waiting
+			connection.close()
+
+		for name in names:
+			try:
+				logger.debug(f'Pulling Docker image {name}')
+				start = time.time()
+				seconds = pull_image(docker, name)
+				record = {
+					'image_id': image_id(docker, name),
+					'pulled': start,
+					'seconds': seconds,
+				}
+			except (DockerError, OSError, HTTPException) as error:
+				# the daemon may be restarting, its socket missing, or the pull may have timed out
+				logger.warning(f'Failed to pull Docker image {name}')
+				logger.debug(error)
+				continue
+
+			state = load_state(args.state_file)
+			previous = state.get(name, {})
+			if previous.get('image_id') != record['image_id']:
+				logger.info(f'Pulled new version of Docker image {name} ({seconds:.1f} seconds)')
+			state[name] = record
+
+			try:
+				save_state(args.state_file, state)
+			except OSError as error:
+				logger.warning('Failed to store records of pulled images')
+				logger.debug(error)
+
+		if args.once:
+			return 0
+
+		time.sleep(args.interval)
+
+
+def pull_image(docker, name):
+	"""
+	Pulls a Docker image. If the local image is already up to date, only its digest is compared.
+
+	Returns
+	-------
+	float
+		Number of seconds the pull took
+	"""
+
+	start = time.perf_counter()
+	docker.pull(name)
+	return time.perf_counter() - start
+
+
+def image_id(docker, name):
+	"""
+	Returns the ID of a local Docker image, which changes whenever the image changes, or `None` if
+	the image is not present.
+	"""
+
+	try:
+		return docker.inspect_image(name)['Id']
+	except NotFoundError:
+		return None
+
+
+def is_prefetched(docker, name, max_age, state_file=STATE_FILE):
+	"""
+	Checks whether a Docker image has been pulled by the prefetcher within the last `max_age`
+	seconds and has not changed since.
+	"""
+
+	record = load_state(state_file).get(name)
+	if not record or time.time() - record['pulled'] > max_age:
+		return False
+	return record['image_id'] is not None and record['image_id'] == image_id(docker, name)
+
+
+def load_state(state_file):
+	"""
+	Loads records of pulled images.
+
+	Returns
+	-------
+	dict
+		Maps names of Docker images to their records
+	"""
+
+	try:
+		with open(state_file) as handle:
+			return json.load(handle)
+	except (IOError, ValueError):
+		return {}
+
+
+def save_state(state_file, state):
+	"""
+	Stores records of pulled images. The file is replaced atomically, since jobs running on the
+	same node may read it at any time.
+	"""
+
+	with open(state_file + '.tmp', 'w') as handle:
+		json.dump(state, handle, indent=1)
+	os.replace(state_file + '.tmp', state_file)
+
+
+if __name__ == '__main__':
+	parser = ArgumentParser()
+	parser.add_argument('--state_file', type=str, default=STATE_FILE,
+		help='Records of pulled images are stored here, should be located on the host')
+	parser.add_argument('--interval', type=float, default=300.,
+		help='Number of seconds to wait between checks for new images')
+	parser.add_argument('--gpu', action='store_true', default=os.path.exists('/dev/nvidiactl'),
+		help='Also pull images of GPU decoders (default if the node has a GPU)')
+	parser.add_argument('--once', action='store_true',
+		help='Pull images only once instead of periodically')
+	parser.add_argument('--docker_socket', type=str, default=SOCKET_PATH,
+		help='Unix socket of the Docker daemon on the host')
+	parser.add_argument('--debug', action='store_true')
+
+	args = parser.parse_args()
+
+	sys.exit(main(args))
@@ -0,0 +1,370 @@
+"""
+Transfers files between local directories and storage buckets.
+
+By default, buckets are stored in Google Cloud Storage and accessed through `gsutil`. If the
+environment variable `STORAGE_ROOT` is set, each bucket is instead a directory of the same name in
+`STORAGE_ROOT`, so that decoding and evaluation can be run on a single machine without access to
+the cloud, for example, to benchmark them.
+
+Transfers mirror `gsutil -m rsync -e -R`. Files are copied in parallel, large files are copied in
+chunks, and copies are verified using checksums. Independent transfers, such as those of submission
+and environment files, can additionally be run at the same time using `run_concurrently`.
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import time
+from cache import hash_file
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from shlex import quote
+from subprocess import run, PIPE
+from tempfile import mkstemp
+
+# files are read and written in chunks of this size
+CHUNK_SIZE = 1 << 23
+
+# the result of a transfer, or the exception it raised, and the number of seconds it took
+Transfer = namedtuple('Transfer', ['result', 'error', 'seconds'])
+
+
+class StorageError(Exception):
+	"""
+	Raised if a transfer fails.
+	"""
+
+
+class Storage:
+	"""
+	A storage bucket.
+
+	Paths refer to locations in the bucket and are relative to its root. Methods raise a
+	`StorageError` if a transfer fails, unless `check` is `False`.
+
+	Parameters
+	----------
+	bucket : str
+		Name of the bucket
+
+	num_threads : int
+		Number of files transferred in parallel, defaults to the backend's choice
+	"""
+
+	def __init__(self, bucket, num_threads=None):
+		self.bucket = bucket
+		self.num_threads = num_threads
+
+	def url(self, path=''):
+		"""
+		Returns a location in the bucket as understood by the backend.
+		"""
+
+		raise NotImplementedError()
+
+	def download(self, path, local_dir, exclude=None, check=True):
+		"""
+		Copies all files in a directory of the bucket and its subdirectories to a local directory.
+		Files which already exist locally with the same size and modification time are skipped.
+
+		Parameters
+		----------
+		exclude : str
+			Regular expression matched against relative paths of files which should not be copied
+		"""
+
+		raise NotImplementedError()
+
+	def download_file(self, path, local_dir, check=True):
+		"""
+		Copies a single file of the bucket to a local directory.
+		"""
+
+		raise NotImplementedError()
+
+	def upload(self, local_dir, path, exclude=None, delete=False, check=True):
+		"""
+		Copies all files in a local directory and its subdirectories to a directory of the bucket.
+		Files which already exist in the bucket with the same size and modification time are
+		skipped.
+
+		Parameters
+		----------
+		delete : bool
+			Also remove files of the bucket's directory which do not exist locally, except those
+			matching `exclude`
+		"""
+
+		raise NotImplementedError()
+
+	def upload_files(self, files, path, check=True):
+		"""
+		Copies local files into a directory of the bucket.
+		"""
+
+		raise NotImplementedError()
+
+	def remove(self, path, check=True):
+		"""
+		Removes a file or a directory of the bucket including its contents.
+		"""
+
+		raise NotImplementedError()
+
+
+class GCSStorage(Storage):
+	"""
+	A bucket in Google Cloud Storage, accessed through `gsutil`.
+
+	Files are transferred in parallel using `gsutil -m`, and `gsutil` verifies transfers using CRC32C
+	or MD5 hashes. Large files are downloaded in slices which are transferred in parallel. Uploads
+	are not split, since downloading composite objects requires a compiled CRC32C implementation
+	which may not be available.
+
+	Parameters
+	----------
+	slice_size : str
+		Files larger than this are downloaded in slices, such as `150M`
+	"""
+
+	def __init__(self, bucket, num_threads=None, slice_size='150M'):
+		super().__init__(bucket, num_threads)
+		self.slice_size = slice_size
+
+	def url(self, path=''):
+		return 'gs://{}/{}'.format(self.bucket, path.strip('/')).rstrip('/')
+
+	def download(self, path, local_dir, exclude=None, check=True):
+		self._gsutil('-m rsync -e -R {exclude} {src}/ {dst}'.format(
+			exclude='-x {}'.format(quote(exclude)) if exclude else '',
+			src=quote(self.url(path)),
+			dst=quote(local_dir)), check=check)
+
+	def download_file(self, path, local_dir, check=True):
+		self._gsutil('cp {src} {dst}/'.format(
+			src=quote(self.url(path)),
+			dst=quote(local_dir)), check=check)
+
+	def upload(self, local_dir, path, exclude=None, delete=False, check=True):
+		self._gsutil('-m rsync -e -C -R {delete} {exclude} {src} {dst}/'.format(
+			delete='-d' if delete else '',
+			exclude='-x {}'.format(quote(exclude)) if exclude else '',
+			src=quote(local_dir),
+			dst=quote(self.url(path))), check=check)
+
+	def upload_files(self, files, path, check=True):
+		if not files:
+			return
+		# paths are passed through stdin, since there may be too many for the command line
+		self._gsutil('-m -q cp -c -P -I {dst}/'.format(dst=quote(self.url(path))),
+			input=''.join(file + '\n' for file in files).encode(),
+			check=check)
+
+	def remove(self, path, check=True):
+		self._gsutil('-m rm -r {}'.format(quote(self.url(path))), check=check)
+
+	def _gsutil(self, command, input=None, check=True):
+		options = ['-o GSUtil:sliced_object_download_threshold={}'.format(self.slice_size)]
+		if self.num_threads:
+			options.append('-o GSUtil:parallel_thread_count={}'.format(self.num_threads))
+
+		process = run('gsutil {options} {command}'.format(options=' '.join(options), command=command),
+			input=input,
+			stdout=PIPE,
+			stderr=PIPE,
+			check=False,
+			shell=True)
+
+		if check and process.returncode:
+			raise StorageError(process.stderr.decode(errors='replace').strip())
+
+
+class LocalStorage(Storage):
+	"""
+	A bucket stored in a local directory.
+
+	Files are copied in chunks by a pool of threads, and each copy is compared to the original
+	using SHA-224 hashes before it replaces an existing file. Modification times are preserved, so
+	that unchanged files are skipped by later transfers.
+
+	Parameters
+	----------
+	root : str
+		Directory containing the bucket's files
+	"""
+
+	def __init__(self, bucket, root, num_threads=None):
+		super().__init__(bucket, num_threads or min(32, (os.cpu_count() or 1) * 4))
+		self.root = root
+
+	def url(self, path=''):
+		return os.path.join(self.root, path.strip('/'))
+
+	def download(self, path, local_dir, exclude=None, check=True):
+		self._sync(self.url(path), local_dir, exclude, False, check)
+
+	def download_file(self, path, local_dir, check=True):
+		self._copy([(self.url(path), os.path.join(local_dir, os.path.basename(path)))], check)
+
+	def upload(self, local_dir, path, exclude=None, delete=False, check=True):
+		self._sync(local_dir, self.url(path), exclude, delete, check)
+
+	def upload_files(self, files, path, check=True):
+		self._copy([(file, os.path.join(self.url(path), os.path.basename(file))) for file in files], check)
+
+	def remove(self, path, check=True):
+		path = self.url(path)
+		try:
+			if os.path.isdir(path):
+				shutil.rmtree(path)
+			else:
+				os.remove(path)
+		except OSError as error:
+			if check:
+				raise StorageError(str(error))
+
+	def _sync(self, src_dir, dst_dir, exclude, delete, check):
+		if not os.path.isdir(src_dir):
+			# like gsutil, treat missing directories as errors
+			if check:
+				raise StorageError('No such directory: {}'.format(src_dir))
+			return
+
+		src_files = list_files(src_dir, exclude)
+		dst_files = list_files(dst_dir, exclude if delete else None)
+
+		self._copy([
+			(os.path.join(src_dir, path), os.path.join(dst_dir, path))
+			for path, stat in sorted(src_files.items()) if dst_files.get(path) != stat], check)
+
+		if delete:
+			for path in sorted(set(dst_files) - set(src_files)):
+				try:
+					os.remove(os.path.join(dst_dir, path))
+				except OSError as error:
+					if check:
+						raise StorageError(str(error))
+
+	def _copy(self, pairs, check):
+		def copy(pair):
+			try:
+				copy_file(*pair)
+			except (OSError, StorageError) as error:
+				return '{}: {}'.format(pair[0], error)
+
+		with ThreadPoolExecutor(self.num_threads) as executor:
+			errors = [error for error in executor.map(copy, pairs) if error]
+
+		if check and errors:
+			raise StorageError('Failed to copy {} files\n{}'.format(len(errors), '\n'.join(errors)))
+
+
+def get_storage(bucket, **kwargs):
+	"""
+	Returns the storage backend of a bucket, which is stored locally if `STORAGE_ROOT` is set.
+
+	Parameters
+	----------
+	bucket : str
+		Name of the bucket
+
+	Returns
+	-------
+	Storage
+	"""
+
+	root = os.environ.get('STORAGE_ROOT')
+	if root:
+		return LocalStorage(bucket, os.path.join(root, bucket), **kwargs)
+	return GCSStorage(bucket, **kwargs)
+
+
+def run_concurrently(tasks):
+	"""
+	Runs independent transfers at the same time.
+
+	Parameters
+	----------
+	tasks : dict
+		Maps names to functions without arguments performing transfers
+
+	Returns
+	-------
+	dict
+		Maps names to a `Transfer`, where exceptions raised by a function are stored instead of
+		propagated
+	"""
+
+	def timed(task):
+		start = time.perf_counter()
+		try:
+			return Transfer(task(), None, time.perf_counter() - start)
+		except Exception as error:
+			return Transfer(None, error, time.perf_counter() - start)
+
+	with ThreadPoolExecutor(len(tasks) or 1) as executor:
+		futures = {name: executor.submit(timed, task) for name, task in tasks.items()}
+	return {name: future.result() for name, future in futures.items()}
+
+
+def list_files(directory, exclude=None):
+	"""
+	Returns
+	-------
+	dict
+		Maps relative paths of files in a directory and its subdirectories to their size and
+		modification time, skipping symbolic links and files matching `exclude`
+	"""
+
+	exclude = re.compile(exclude) if exclude else None
+
+	files = {}
+	for dir_path, _, file_names in os.walk(directory):
+		for file_name in file_names:
+			path = os.path.join(dir_path, file_name)
+			relative_path = os.path.relpath(path, directory)
+			if exclude and exclude.match(relative_path):
+				continue
+			try:
+				stat = os.lstat(path)
+			except OSError:
+				continue
+			if os.path.islink(path):
+				continue
+			files[relative_path] = stat.st_size, stat.st_mtime_ns
+	return files
+
+
+def copy_file(src, dst, chunk_size=CHUNK_SIZE):
+	"""
+	Copies a file in chunks, preserving its modification time and permissions.
+
+	The copy is written to a temporary file next to its destination, which replaces the destination
+	only after its SHA-224 hash has been found to match the hash of the original file.
+	"""
+
+	dst_dir = os.path.dirname(dst)
+	os.makedirs(dst_dir, exist_ok=True)
+
+	stat = os.stat(src)
+	fd, tmp_path = mkstemp(dir=dst_dir, prefix='.' + os.path.basename(dst) + '.', suffix='.part')
+
+	try:
+		src_hash = hashlib.sha224()
+		with open(src, 'rb') as src_handle, os.fdopen(fd, 'wb') as dst_handle:
+			for chunk in iter(lambda: src_handle.read(chunk_size), b''):
+				src_hash.update(chunk)
+				dst_handle.write(chunk)
+
+		if hash_file(tmp_path, chunk_size) != src_hash.hexdigest():
+			raise StorageError('Checksum of copy does not match')
+
+		os.chmod(tmp_path, stat.st_mode & 0o7777)
+		os.utime(tmp_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+		os.replace(tmp_path, dst)
+	except:
+		if os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		raise
+
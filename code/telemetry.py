@@ -0,0 +1,198 @@
+"""
+Measures the resources used by a decoder while it runs.
+
+The resource usage of a container is sampled in a background thread, which uses its own connection
+to the Docker daemon, since the connection used for waiting on the container is blocked.
+"""
+
+import json
+import os
+import shutil
+import threading
+import time
+from subprocess import run, CalledProcessError, PIPE
+from docker_client import SOCKET_PATH, DockerClient, DockerError
+
+# locations of nvidia-smi, which is mounted into containers of pods requesting GPUs on GKE
+NVIDIA_SMI_PATHS = ['/usr/local/nvidia/bin/nvidia-smi', '/home/kubernetes/bin/nvidia/bin/nvidia-smi']
+
+
+class ContainerMonitor:
+	"""
+	Periodically records the CPU time, memory usage, block I/O, and GPU utilization of a container.
+
+	Parameters
+	----------
+	container : str
+		Name or ID of a running container
+
+	interval : float
+		Number of seconds between samples
+
+	gpu : bool
+		Whether to additionally record the utilization of GPUs
+	"""
+
+	def __init__(self, container, interval=1., gpu=False, socket_path=SOCKET_PATH):
+		self.container = container
+		self.interval = interval
+		self.samples = []
+		self.errors = 0
+		self._start = None
+		self._end = None
+
+		self._docker = DockerClient(socket_path)
+		self._nvidia_smi = None
+		if gpu:
+			self._nvidia_smi = shutil.which('nvidia-smi') or next(
+				(path for path in NVIDIA_SMI_PATHS if os.path.exists(path)), None)
+
+		self._stop = threading.Event()
+		self._thread = threading.Thread(target=self._run, daemon=True)
+
+	def start(self):
+		self._start = time.time()
+		self._thread.start()
+		return self
+
+	def stop(self):
+		"""
+		Stops sampling and waits for the background thread to finish.
+		"""
+
+		self._stop.set()
+		self._thread.join()
+		self._docker.close()
+		self._end = time.time()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *args):
+		self.stop()
+
+	def _run(self):
+		while True:
+			try:
+				sample = {'time': time.time() - self._start}
+				sample.update(container_usage(self._docker.stats(self.container)))
+				if self._nvidia_smi:
+					sample.update(gpu_usage(self._nvidia_smi))
+				self.samples.append(sample)
+			except (DockerError, CalledProcessError, OSError, ValueError):
+				# the container may have exited between samples
+				self.errors += 1
+
+			if self._stop.wait(self.interval):
+				break
+
+	def summary(self):
+		"""
+		Summarizes the resource usage of the container over its lifetime.
+
+		Returns
+		-------
+		dict
+			Total CPU time, average CPU utilization, peak memory usage among samples, bytes read and
+			written, and, if available, average and peak GPU utilization and peak GPU memory usage
+		"""
+
+		samples = [sample for sample in self.samples if sample.get('cpu_seconds')]
+		if not samples:
+			return {}
+
+		wall_seconds = (self._end or time.time()) - self._start
+		summary = {
+			'num_samples': len(samples),
+			'wall_seconds': wall_seconds,
+			'cpu_seconds': samples[-1]['cpu_seconds'],
+			'cpu_utilization': samples[-1]['cpu_seconds'] / samples[-1]['time'] if samples[-1]['time'] else None,
+			'peak_memory': max(sample['memory'] for sample in samples),
+			'read_bytes': samples[-1]['read_bytes'],
+			'write_bytes': samples[-1]['write_bytes'],
+		}
+
+		if 'max_usage' in samples[-1]:
+			summary['max_usage'] = max(sample['max_usage'] for sample in samples)
+
+		gpu_samples = [sample for sample in samples if 'gpu_utilization' in sample]
+		if gpu_samples:
+			summary['gpu_utilization'] = sum(
+				sample['gpu_utilization'] for sample in gpu_samples) / len(gpu_samples)
+			summary['peak_gpu_utilization'] = max(sample['gpu_utilization'] for sample in gpu_samples)
+			summary['peak_gpu_memory'] = max(sample['gpu_memory'] for sample in gpu_samples)
+
+		return summary
+
+	def save(self, filename):
+		"""
+		Stores samples and their summary as JSON.
+		"""
+
+		with open(filename, 'w') as handle:
+			json.dump({
+				'interval': self.interval,
+				'summary': self.summary(),
+				'samples': self.samples,
+			}, handle, indent=1)
+
+
+def container_usage(stats):
+	"""
+	Extracts resource usage from statistics reported by the Docker daemon.
+
+	Returns
+	-------
+	dict
+		Cumulative CPU time in seconds, memory usage in bytes, and cumulative number of bytes
+		read and written by block devices
+	"""
+
+	memory_stats = stats.get('memory_stats', {})
+	memory = memory_stats.get('usage', 0)
+
+	# page cache is included in the memory usage reported by cgroups
+	memory_details = memory_stats.get('stats', {})
+	memory -= memory_details.get('total_inactive_file', memory_details.get('inactive_file', 0))
+
+	read_bytes, write_bytes = 0, 0
+	for entry in stats.get('blkio_stats', {}).get('io_service_bytes_recursive') or []:
+		if entry['op'].lower() == 'read':
+			read_bytes += entry['value']
+		elif entry['op'].lower() == 'write':
+			write_bytes += entry['value']
+
+	usage = {
+		'cpu_seconds': stats.get('cpu_stats', {}).get('cpu_usage', {}).get('total_usage', 0) / 1e9,
+		'memory': memory,
+		'read_bytes': read_bytes,
+		'write_bytes': write_bytes,
+	}
+
+	if 'max_usage' in memory_stats:
+		# peak memory usage including page cache, only reported with cgroups v1
+		usage['max_usage'] = memory_stats['max_usage']
+
+	return usage
+
+
+def gpu_usage(nvidia_smi):
+	"""
+	Queries the utilization of GPUs.
+
+	Returns
+	-------
+	dict
+		GPU utilization in percent and GPU memory usage in bytes, summed over GPUs
+	"""
+
+	process = run([nvidia_smi, '--query-gpu=utilization.gpu,memory.used', '--format=csv,noheader,nounits'],
+		stdout=PIPE, stderr=PIPE, check=True)
+
+	utilization, memory = 0., 0.
+	for line in process.stdout.decode().strip().splitlines():
+		values = line.split(',')
+		utilization += float(values[0])
+		memory += float(values[1]) * 1024 * 1024
+
+	return {'gpu_utilization': utilization, 'gpu_memory': memory}
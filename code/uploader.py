@@ -0,0 +1,344 @@
+"""
+Uploads files to a storage bucket while they are being written by a decoder.
+
+Files are uploaded once they have been closed after writing. Changes are detected with inotify if
+it is available and by periodically scanning the directory otherwise, in which case files are
+considered complete once their size and modification time stop changing.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+from storage import StorageError
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+# header of an inotify event: watch descriptor, mask, cookie, and length of the name
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class OutputUploader:
+	"""
+	Watches a directory and uploads completed files in the background.
+
+	Uploads are performed in batches, one per subdirectory. Files which exist before the uploader is
+	started are ignored unless they are modified, but are listed in the manifest.
+
+	Parameters
+	----------
+	directory : str
+		Local directory to watch
+
+	storage : Storage
+		Bucket to which files are uploaded
+
+	destination : str
+		Location in the bucket corresponding to `directory`
+
+	interval : float
+		Number of seconds between uploads
+
+	poll : bool
+		Detect changes by scanning the directory even if inotify is available
+
+	manifest : str
+		If given, paths of completed files relative to `directory` are appended to this file as
+		soon as they are detected, so that other processes can use files while others are still
+		being written
+	"""
+
+	def __init__(self, directory, storage, destination, interval=10., poll=False, manifest=None, logger=None):
+		self.directory = os.path.abspath(directory)
+		self.storage = storage
+		self.destination = destination.rstrip('/')
+		self.interval = interval
+		self.manifest = manifest and os.path.abspath(manifest)
+		self.logger = logger
+
+		# maps uploaded files to their size and modification time when they were uploaded
+		self.uploaded = {}
+		self.num_failed = 0
+
+		self._pending = set()
+		self._lock = threading.Lock()
+		self._stop = threading.Event()
+
+		self._inotify = None if poll else Inotify.create()
+		self._existing = {}
+		self._snapshot = {}
+
+		self._watcher = threading.Thread(target=self._watch, daemon=True)
+		self._uploader = threading.Thread(target=self._upload, daemon=True)
+
+	def start(self):
+		# size and modification time of files which existed before
+		self._existing = scan(self.directory)
+		self._snapshot = self._existing
+
+		if self.manifest:
+			# files which existed before, such as submitted files, are complete
+			self._append_to_manifest(sorted(self._existing))
+
+		if self._inotify:
+			try:
+				for path in self._directories():
+					self._inotify.add_watch(path)
+			except OSError:
+				# for example, if the maximum number of watches is exceeded
+				self._inotify.close()
+				self._inotify = None
+		self._watcher.start()
+		self._uploader.start()
+		return self
+
+	def stop(self):
+		"""
+		Stops watching the directory and waits until all completed files have been uploaded.
+		"""
+
+		if self._watcher.ident is None:
+			# uploader was never started
+			return
+
+		self._stop.set()
+		self._watcher.join()
+		self._uploader.join()
+		if self._inotify:
+			self._inotify.close()
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *args):
+		self.stop()
+
+	def _directories(self):
+		for dir_path, _, _ in os.walk(self.directory):
+			yield dir_path
+
+	def _add(self, paths):
+		paths = [path for path in paths if path != self.manifest]
+		if not paths:
+			return
+
+		with self._lock:
+			self._pending.update(paths)
+
+		if self.manifest:
+			self._append_to_manifest(paths)
+
+	def _append_to_manifest(self, paths):
+		with open(self.manifest, 'a') as handle:
+			handle.writelines(
+				os.path.relpath(path, self.directory) + '\n' for path in paths if path != self.manifest)
+
+	def _watch(self):
+		if self._inotify:
+			while not self._stop.is_set():
+				self._add(self._read_events(timeout=min(self.interval, 1.)))
+			# collect events which occurred just before stopping
+			self._add(self._read_events(timeout=0.))
+		else:
+			while not self._stop.wait(self.interval):
+				self._add(self._poll())
+			self._add(self._poll(final=True))
+
+	def _read_events(self, timeout):
+		"""
+		Returns
+		-------
+		list[str]
+			Files which were closed after writing or moved into a watched directory
+		"""
+
+		paths = []
+
+		for wd, mask, name in self._inotify.read(timeout):
+			if mask & IN_Q_OVERFLOW:
+				# events were lost, so every file which may have changed is uploaded
+				paths.extend(path for path, stat in scan(self.directory).items()
+					if self._existing.get(path) != stat)
+				continue
+
+			if wd not in self._inotify.paths:
+				continue
+
+			path = os.path.join(self._inotify.paths[wd], name)
+
+			if mask & IN_ISDIR:
+				if mask & (IN_CREATE | IN_MOVED_TO):
+					# watch new directory and include files created before the watch was added
+					for dir_path, _, file_names in os.walk(path):
+						try:
+							self._inotify.add_watch(dir_path)
+						except OSError:
+							# directory was removed in the meantime
+							continue
+						paths.extend(os.path.join(dir_path, file_name) for file_name in file_names)
+			elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+				paths.append(path)
+
+		return paths
+
+	def _poll(self, final=False):
+		"""
+		Returns
+		-------
+		list[str]
+			Files whose size and modification time did not change since the last scan, or all
+			changed files if `final` is set
+		"""
+
+		snapshot = scan(self.directory)
+		paths = [path for path, stat in snapshot.items()
+			if (final or self._snapshot.get(path) == stat)
+			and self._existing.get(path) != stat
+			and self.uploaded.get(path) != stat]
+
+		self._snapshot = snapshot
+		return paths
+
+	def _upload(self):
+		while not self._stop.wait(self.interval):
+			self.flush()
+		self._watcher.join()
+		self.flush()
+
+	def flush(self):
+		"""
+		Uploads all completed files which have not been uploaded yet.
+		"""
+
+		with self._lock:
+			paths, self._pending = self._pending, set()
+
+		# group files by directory, since each directory requires its own destination
+		directories = {}
+		for path in paths:
+			try:
+				stat = file_stat(path)
+			except OSError:
+				# file was deleted in the meantime
+				continue
+			if self.uploaded.get(path) == stat:
+				continue
+			directories.setdefault(os.path.dirname(path), {})[path] = stat
+
+		for directory, files in sorted(directories.items()):
+			relative_path = os.path.relpath(directory, self.directory)
+			destination = self.destination if relative_path == '.' else self.destination + '/' + relative_path
+
+			try:
+				self.storage.upload_files(sorted(files), destination)
+			except StorageError as error:
+				# files are uploaded again by the final synchronization
+				self.num_failed += len(files)
+				if self.logger:
+					self.logger.debug('Failed to upload files in {}'.format(relative_path))
+					self.logger.debug(error)
+			else:
+				self.uploaded.update(files)
+
+
+class Inotify:
+	"""
+	Thin wrapper around the inotify API of Linux.
+	"""
+
+	MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+	def __init__(self, libc, fd):
+		self._libc = libc
+		self.fd = fd
+		# maps watch descriptors to directories
+		self.paths = {}
+
+	@classmethod
+	def create(cls):
+		"""
+		Returns
+		-------
+		Inotify
+			An instance, or `None` if inotify is not available
+		"""
+
+		try:
+			libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+			fd = libc.inotify_init1(os.O_CLOEXEC)
+		except (OSError, AttributeError):
+			return None
+		if fd < 0:
+			return None
+		return cls(libc, fd)
+
+	def add_watch(self, path):
+		wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+		if wd < 0:
+			errno = ctypes.get_errno()
+			raise OSError(errno, os.strerror(errno), path)
+		self.paths[wd] = path
+		return wd
+
+	def read(self, timeout):
+		"""
+		Waits up to `timeout` seconds for events.
+
+		Returns
+		-------
+		list[tuple]
+			Watch descriptor, mask, and name of the file for each event
+		"""
+
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return []
+
+		data = os.read(self.fd, 1 << 16)
+		events = []
+		offset = 0
+
+		while offset < len(data):
+			wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+			offset += EVENT_HEADER.size
+			name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+			offset += length
+			events.append((wd, mask, name))
+
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+
+def file_stat(path):
+	"""
+	Returns the size and modification time of a file.
+	"""
+
+	stat = os.stat(path)
+	return stat.st_size, stat.st_mtime_ns
+
+
+def scan(directory):
+	"""
+	Returns
+	-------
+	dict
+		Maps each file in a directory and its subdirectories to its size and modification time
+	"""
+
+	files = {}
+	for dir_path, _, file_names in os.walk(directory):
+		for file_name in file_names:
+			path = os.path.join(dir_path, file_name)
+			try:
+				files[path] = file_stat(path)
+			except OSError:
+				pass
+	return files
@@ -1,8 +1,10 @@
+import json
 import logging
 import os
 import subprocess
 import sys
 import time
+from contextlib import contextmanager
 
 from django import setup as django_setup
 from django.conf import settings as django_settings
@@ -107,3 +109,56 @@ def get_logger(debug=False, warn=True, stdout=sys.stdout, stderr=sys.stderr, fil
 		logger.addHandler(handler)
 
 	return logger
+
+
+class Timer:
+	"""
+	Records how long different stages of a job take.
+
+	Stages can be nested, in which case the names of enclosing stages are prepended to the name of
+	a stage, as in `evaluate/MSSSIM`. Stages are timed using
+
+		with timer.stage('download'):
+			...
+	"""
+
+	def __init__(self):
+		self.records = []
+		self._stages = []
+
+	@contextmanager
+	def stage(self, name):
+		"""
+		Measures the time spent in a block of code.
+		"""
+
+		self._stages.append(name)
+		record = {'stage': '/'.join(self._stages), 'start': time.time()}
+		self.records.append(record)
+		start = time.perf_counter()
+
+		try:
+			yield record
+		finally:
+			record['seconds'] = time.perf_counter() - start
+			self._stages.pop()
+
+	def add(self, name, seconds, **kwargs):
+		"""
+		Records the time of a stage measured elsewhere, for example, the time spent computing a
+		metric summed across multiple workers.
+		"""
+
+		self.records.append(dict(
+			stage='/'.join(self._stages + [name]),
+			start=None,
+			seconds=seconds,
+			**kwargs))
+
+	def save(self, filename):
+		"""
+		Stores records as JSON.
+		"""
+
+		with open(filename, 'w') as handle:
+			json.dump({'records': self.records}, handle, indent=1)
@@ -0,0 +1,326 @@
+"""
+Evaluation of video tracks.
+
+Videos are evaluated one frame at a time, so that memory usage does not depend on the length of a
+sequence. A phase evaluates videos if its settings contain a `video` entry, for example
+
+    "video": {
+        "format": "yuv420p",
+        "bit_depth": 8,
+        "width": 1920,
+        "height": 1080
+    }
+
+Sequences are either directories of PNG frames (format `png`), whose frames are ordered by name, or
+raw planar YUV files (formats `yuv420p` and `yuv444p`). The frame size of a YUV file is taken from
+`sequences`, which maps names of sequences to their settings, from `width` and `height`, or from
+a file name such as `BasketballDrive_1920x1080_50.yuv`.
+"""
+
+import os
+import re
+import numpy as np
+from glob import glob
+from metrics import MSSSIM_BYTES_PER_VALUE, image_size, load_image, max_tile_size, mse, mse2psnr
+from metrics import msssim, parallel_map, prefetch
+from msssim import MultiScaleSSIMTiled
+
+# vertical and horizontal subsampling of chroma planes
+YUV_FORMATS = {
+    'yuv420p': (2, 2),
+    'yuv444p': (1, 1),
+}
+
+FRAME_SIZE_PATTERN = re.compile(r'(\d+)x(\d+)')
+
+
+def evaluate(submission_sequences, target_sequences, layouts, settings={}, logger=None):
+    """
+    Calculates metrics for the given video sequences.
+
+    Metrics are computed for each frame. The metrics of a sequence are averages over its frames,
+    and the metrics of the dataset are averages over sequences.
+
+    Parameters
+    ----------
+    submission_sequences : dict
+        Maps names of sequences to a directory of PNG frames or to a YUV file
+
+    target_sequences : dict
+        Maps names of sequences to a directory of PNG frames or to a YUV file
+
+    layouts : dict
+        Maps names of sequences to frame layouts as returned by `check_sequences`
+
+    Returns
+    -------
+    tuple
+        A dictionary of metrics of the dataset and a dictionary mapping names of sequences to
+        their metrics
+    """
+
+    video_settings = settings['video']
+    metrics = [metric for metric in settings.get('metrics', ['PSNR', 'MSSSIM'])
+        if metric in ['PSNR', 'MSSSIM']]
+
+    options = {
+        'metrics': metrics,
+        'msssim_backend': settings.get('msssim_backend', 'reference'),
+        'tile_memory': settings.get('tile_memory'),
+        'prefetch': settings.get('prefetch', 2),
+        'max_psnr': video_settings.get('max_psnr', 100.),
+    }
+
+    names = sorted(target_sequences)
+    jobs = [(target_sequences[name], submission_sequences[name], layouts[name], options)
+        for name in names]
+
+    sequence_results = {}
+
+    for name, result in zip(names, parallel_map(
+            _evaluate_sequence,
+            jobs,
+            num_workers=settings.get('num_workers', 1) or os.cpu_count(),
+            executor=settings.get('executor', 'process'))):
+        if 'MSSSIM' in metrics:
+            num_failed = int(np.sum(np.isnan(result['frames']['MSSSIM'])))
+            if num_failed and logger:
+                logger.warning(
+                    f'Evaluation of MSSSIM for {num_failed} frames of `{name}` returned NaN. '
+                    'Assuming MSSSIM is zero.')
+            result['frames']['MSSSIM'] = np.nan_to_num(result['frames']['MSSSIM']).tolist()
+
+        for metric in metrics:
+            result[metric] = float(np.mean(result['frames'][metric]))
+
+        if logger:
+            logger.debug('Metrics for sequence `{name}` ({num_frames} frames): {values}'.format(
+                name=name,
+                num_frames=result['num_frames'],
+                values=', '.join(f'{metric}: {result[metric]}' for metric in metrics)))
+
+        sequence_results[name] = result
+
+    results = {}
+    for metric in metrics:
+        results[metric] = np.mean([result[metric] for result in sequence_results.values()])
+
+    return results, sequence_results
+
+
+def _evaluate_sequence(job):
+    """
+    Computes metrics for each frame of a sequence.
+    """
+
+    target_source, submission_source, layout, options = job
+    metrics = options['metrics']
+    max_val = 2 ** layout['bit_depth'] - 1
+
+    if layout['format'] == 'png':
+        # decode upcoming frames on other threads while the current frame is scored
+        frames = prefetch(
+            _load_frames,
+            [(os.path.join(target_source, frame), os.path.join(submission_source, frame))
+                for frame in layout['frames']],
+            depth=max(1, options['prefetch']))
+    else:
+        frames = zip(read_yuv(target_source, layout), read_yuv(submission_source, layout))
+
+    values = {metric: [] for metric in metrics}
+    num_frames = 0
+
+    for planes0, planes1 in frames:
+        if 'PSNR' in metrics:
+            sqerror = sum(mse(plane1, plane0) for plane0, plane1 in zip(planes0, planes1))
+            num_dims = sum(plane.size for plane in planes0)
+            psnr = mse2psnr(sqerror / num_dims, max_val) if sqerror else np.inf
+            values['PSNR'].append(float(min(psnr, options['max_psnr'])))
+        if 'MSSSIM' in metrics:
+            # MS-SSIM is computed on RGB frames or on the luma plane
+            image0 = planes0[0] if planes0[0].ndim == 3 else planes0[0][..., None]
+            image1 = planes1[0] if planes1[0].ndim == 3 else planes1[0][..., None]
+            values['MSSSIM'].append(float(frame_msssim(image0, image1, options, max_val)))
+        num_frames += 1
+
+    return {'num_frames': num_frames, 'frames': values}
+
+
+def _load_frames(files):
+    """
+    Loads a pair of PNG frames.
+    """
+
+    return [load_image(files[0])], [load_image(files[1])]
+
+
+def frame_msssim(image0, image1, options, max_val=255):
+    """
+    Computes MS-SSIM of a single frame. Frames whose evaluation would exceed the memory limit given
+    by `options['tile_memory']` are processed in tiles.
+    """
+
+    tile_memory = options['tile_memory']
+    bytes_per_value = MSSSIM_BYTES_PER_VALUE[options['msssim_backend']]
+
+    if tile_memory is not None and bytes_per_value * image0.size > tile_memory * 1e6:
+        return MultiScaleSSIMTiled(
+            image0[None], image1[None],
+            max_val=max_val,
+            tile_size=max_tile_size(tile_memory, image0.shape[2]))
+    return msssim(image0, image1, options['msssim_backend'], max_val=max_val)
+
+
+def read_yuv(file_name, layout):
+    """
+    Reads a raw planar YUV file one frame at a time.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to a YUV file
+
+    layout : dict
+        Frame layout as returned by `check_sequences`
+
+    Returns
+    -------
+    generator
+        Yields a list of Y, U, and V planes for each frame
+    """
+
+    shapes = plane_shapes(layout)
+    dtype = np.dtype('<u2') if layout['bit_depth'] > 8 else np.dtype(np.uint8)
+
+    with open(file_name, 'rb') as handle:
+        for _ in range(layout['num_frames']):
+            planes = []
+            for shape in shapes:
+                plane = np.fromfile(handle, dtype=dtype, count=shape[0] * shape[1])
+                if plane.size < shape[0] * shape[1]:
+                    raise IOError(f'Unexpected end of file in `{file_name}`')
+                planes.append(plane.reshape(shape))
+            yield planes
+
+
+def plane_shapes(layout):
+    """
+    Returns the shapes of the Y, U, and V planes of a frame.
+    """
+
+    height, width = layout['height'], layout['width']
+    sub_y, sub_x = YUV_FORMATS[layout['format']]
+    chroma_shape = (-(-height // sub_y), -(-width // sub_x))
+    return [(height, width), chroma_shape, chroma_shape]
+
+
+def frame_bytes(layout):
+    """
+    Number of bytes needed to store a single frame of a YUV file.
+    """
+
+    bytes_per_value = 2 if layout['bit_depth'] > 8 else 1
+    return bytes_per_value * sum(height * width for height, width in plane_shapes(layout))
+
+
+def find_sequences(directory, video_settings, recursive=False):
+    """
+    Locates video sequences in a directory.
+
+    Sequences are named after directories containing PNG frames or after YUV files. If `recursive`
+    is set, sequences are also searched for in subdirectories.
+
+    Returns
+    -------
+    dict
+        Maps names of sequences to a directory of PNG frames or to a YUV file
+    """
+
+    pattern = os.path.join(directory, '**' if recursive else '', '*')
+
+    if video_settings.get('format', 'png') == 'png':
+        frame_dirs = set(os.path.dirname(path) for path in glob(
+            os.path.join(pattern, '*.png'), recursive=recursive))
+        return {os.path.basename(path): path for path in frame_dirs}
+
+    return {os.path.splitext(os.path.basename(path))[0]: path
+        for path in glob(pattern + '.yuv', recursive=recursive)}
+
+
+def check_sequences(names, submission_sequences, target_sequences, video_settings):
+    """
+    Determines the layout of frames of each sequence and compares submitted sequences to the
+    target sequences.
+
+    Returns
+    -------
+    tuple
+        A dictionary mapping names of sequences to frame layouts and an error message, which is
+        `None` if all sequences have the correct number and size of frames
+    """
+
+    layouts = {}
+    video_format = video_settings.get('format', 'png')
+
+    if video_format != 'png' and video_format not in YUV_FORMATS:
+        return layouts, f'Unknown video format `{video_format}`'
+
+    for name in names:
+        # settings of individual sequences take precedence
+        sequence_settings = dict(video_settings)
+        sequence_settings.update(video_settings.get('sequences', {}).get(name, {}))
+
+        if video_format == 'png':
+            frames = sorted(os.path.basename(path)
+                for path in glob(os.path.join(target_sequences[name], '*.png')))
+
+            for frame in frames:
+                target_size = image_size(os.path.join(target_sequences[name], frame))
+                try:
+                    submission_size = image_size(os.path.join(submission_sequences[name], frame))
+                except (IOError, SyntaxError):
+                    return layouts, f'Frame {frame} of sequence {name} is missing or could not be read'
+                if submission_size != target_size:
+                    return layouts, 'Frame {frame} of sequence {name} has incorrect size ({image_size} instead of {target_size})'.format(
+                        frame=frame,
+                        name=name,
+                        image_size='x'.join(map(str, submission_size[::-1])),
+                        target_size='x'.join(map(str, target_size[::-1])))
+
+            layouts[name] = {
+                'format': video_format,
+                'bit_depth': 8,
+                'frames': frames,
+            }
+
+        else:
+            if 'width' in sequence_settings and 'height' in sequence_settings:
+                width, height = sequence_settings['width'], sequence_settings['height']
+            else:
+                match = FRAME_SIZE_PATTERN.search(name)
+                if match is None:
+                    return layouts, f'Frame size of sequence {name} is unknown'
+                width, height = int(match.group(1)), int(match.group(2))
+
+            layout = {
+                'format': video_format,
+                'bit_depth': sequence_settings.get('bit_depth', 8),
+                'width': width,
+                'height': height,
+            }
+
+            target_bytes = os.path.getsize(target_sequences[name])
+            submission_bytes = os.path.getsize(submission_sequences[name])
+
+            if target_bytes % frame_bytes(layout):
+                return layouts, f'Size of target sequence {name} is not a multiple of the frame size'
+            if submission_bytes != target_bytes:
+                return layouts, 'Sequence {name} has incorrect size ({submission_bytes} instead of {target_bytes} bytes)'.format(
+                    name=name,
+                    submission_bytes=submission_bytes,
+                    target_bytes=target_bytes)
+
+            layout['num_frames'] = target_bytes // frame_bytes(layout)
+            layouts[name] = layout
+
+    return layouts, None
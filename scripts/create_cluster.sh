@@ -70,5 +70,8 @@ kubectl create secret generic sentry-${LABEL} --from-literal dsn="$SENTRY_DSN"
 # add evaluation code to kubernetes
 kubectl create configmap code-${LABEL} --from-file code/
 
+# keep Docker images of decoders up to date on all nodes
+kubectl apply -f scripts/prefetch.yaml
+
 # add SSL keys
 kubectl create secret generic clic-ssl-key --from-file ssl
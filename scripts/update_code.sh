@@ -3,3 +3,6 @@
 LABEL=clic2022
 kubectl delete configmap code-${LABEL} 2> /dev/null
 kubectl create configmap code-${LABEL} --from-file code
+
+# restart prefetcher so that it uses the new code
+kubectl rollout restart daemonset prefetch-${LABEL} 2> /dev/null
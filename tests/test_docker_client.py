@@ -0,0 +1,207 @@
+"""
+Tests the Docker client against a fake Docker daemon listening on a Unix socket.
+
+	python3 -m unittest discover tests
+"""
+
+import itertools
+import json
+import os
+import socketserver
+import struct
+import sys
+import threading
+import time
+import unittest
+from http.client import RemoteDisconnected
+from http.server import BaseHTTPRequestHandler
+from tempfile import mkdtemp
+from shutil import rmtree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+from docker_client import DockerClient, DockerError, NotFoundError
+
+
+class FakeDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	"""
+	Answers requests to the Docker Engine API with canned responses.
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, socket_path):
+		super().__init__(socket_path, FakeHandler)
+
+		# method, path and number of the connection of each request received
+		self.requests = []
+		self.connections = itertools.count()
+
+		# paths of requests whose connection is closed without a response
+		self.drop = set()
+
+		# close connections after each response without telling the client
+		self.close_silently = False
+
+		self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self.shutdown()
+		self.server_close()
+
+	def handle_error(self, request, client_address):
+		# clients may close connections before receiving a response
+		pass
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def setup(self):
+		super().setup()
+		self.connection_id = next(self.server.connections)
+
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		self.handle_request('GET')
+
+	def do_POST(self):
+		self.handle_request('POST')
+
+	def do_DELETE(self):
+		self.handle_request('DELETE')
+
+	def handle_request(self, method):
+		length = int(self.headers.get('Content-Length', 0))
+		body = self.rfile.read(length) if length else b''
+		path = self.path.split('?')[0]
+		self.server.requests.append((method, path, self.connection_id))
+
+		if path in self.server.drop:
+			# request was received, but the connection is closed before responding
+			self.server.drop.discard(path)
+			self.close_connection = True
+			return
+
+		if path == '/_ping':
+			self.respond(200, b'OK', 'text/plain')
+		elif path == '/containers/create':
+			self.respond(201, {'Id': 'abc', 'Config': json.loads(body.decode())})
+		elif path == '/containers/decoder/json':
+			self.respond(200, {'Config': {'Tty': False}, 'State': {'OOMKilled': True}})
+		elif path == '/containers/decoder/logs':
+			frame = lambda stream, data: struct.pack('>BxxxI', stream, len(data)) + data
+			self.respond(
+				200,
+				frame(1, b'hello ') + frame(2, b'world'),
+				'application/vnd.docker.multiplexed-stream')
+		elif path == '/containers/decoder/wait':
+			self.respond(200, {'StatusCode': 137})
+		elif path == '/containers/slow/wait':
+			time.sleep(1.)
+			self.respond(200, {'StatusCode': 0})
+		elif path == '/images/create':
+			self.respond(
+				200,
+				b'{"status": "Pulling"}\n{"error": "access denied"}\n',
+				'application/json')
+		elif method == 'POST' and path.startswith('/containers/'):
+			self.respond(204, b'')
+		else:
+			self.respond(404, {'message': 'No such object'})
+
+		if self.server.close_silently:
+			self.close_connection = True
+
+	def respond(self, status, data, content_type='application/json'):
+		if not isinstance(data, bytes):
+			data = json.dumps(data).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+
+class TestDockerClient(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = mkdtemp()
+		self.socket_path = os.path.join(self.tmp_dir, 'docker.sock')
+		self.daemon = FakeDaemon(self.socket_path)
+		self.client = DockerClient(self.socket_path, timeout=5.)
+
+	def tearDown(self):
+		self.client.close()
+		self.daemon.stop()
+		rmtree(self.tmp_dir)
+
+	def test_lifecycle(self):
+		self.assertTrue(self.client.ping())
+		self.assertEqual(self.client.create_container('decoder', {'Image': 'ubuntu'}), 'abc')
+		self.client.start('decoder')
+		self.assertEqual(self.client.wait('decoder', timeout=5.), 137)
+		self.assertTrue(self.client.inspect('decoder')['State']['OOMKilled'])
+		self.client.kill('decoder')
+
+		# all requests are sent over the same connection
+		self.assertEqual(len(set(connection for _, _, connection in self.daemon.requests)), 1)
+
+	def test_logs(self):
+		# stdout and stderr are demultiplexed
+		self.assertEqual(self.client.logs('decoder'), b'hello world')
+
+	def test_errors(self):
+		with self.assertRaises(NotFoundError):
+			self.client.inspect_image('missing:latest')
+		with self.assertRaises(DockerError):
+			# errors may occur in the middle of the progress reported by a pull
+			self.client.pull('registry:5000/image')
+		with self.assertRaises(TimeoutError):
+			self.client.wait('slow', timeout=.1)
+
+		# the client recovers after a timeout
+		self.assertTrue(self.client.ping())
+
+	def test_reconnect(self):
+		# the daemon closes idle connections without notice
+		self.daemon.close_silently = True
+		self.assertTrue(self.client.ping())
+		time.sleep(.1)
+		self.assertEqual(self.client.create_container('decoder', {'Image': 'ubuntu'}), 'abc')
+		self.assertTrue(self.client.ping())
+
+		requests = [(method, path) for method, path, _ in self.daemon.requests]
+		self.assertEqual(requests, [
+			('GET', '/_ping'),
+			('POST', '/containers/create'),
+			('GET', '/_ping')])
+		self.assertEqual(len(set(connection for _, _, connection in self.daemon.requests)), 3)
+
+	def test_retry_idempotent(self):
+		self.assertTrue(self.client.ping())
+
+		# a request lost on a reused connection is sent again over a new connection
+		self.daemon.drop.add('/containers/decoder/json')
+		self.assertTrue(self.client.inspect('decoder')['State']['OOMKilled'])
+		paths = [path for _, path, _ in self.daemon.requests]
+		self.assertEqual(paths.count('/containers/decoder/json'), 2)
+
+	def test_no_retry_non_idempotent(self):
+		self.assertTrue(self.client.ping())
+
+		# the daemon may have created the container, so the request must not be sent again
+		self.daemon.drop.add('/containers/create')
+		with self.assertRaises(RemoteDisconnected):
+			self.client.create_container('decoder', {'Image': 'ubuntu'})
+		paths = [path for _, path, _ in self.daemon.requests]
+		self.assertEqual(paths.count('/containers/create'), 1)
+
+		# a new connection is used afterwards
+		self.assertTrue(self.client.ping())
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,85 @@
+"""
+Tests how outputs of a decoder are passed to a pipelined evaluation.
+
+	python3 -m unittest discover tests
+"""
+
+import os
+import sys
+import unittest
+from tempfile import mkdtemp
+from shutil import rmtree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code'))
+
+from pipeline import DECODED_NAME, MANIFEST_NAME, DecoderOutputs, mark
+from storage import LocalStorage
+from uploader import OutputUploader
+
+
+class TestPipeline(unittest.TestCase):
+	def setUp(self):
+		self.tmp_dir = mkdtemp()
+		self.work_dir = os.path.join(self.tmp_dir, 'work')
+		self.bucket_dir = os.path.join(self.tmp_dir, 'bucket')
+		os.makedirs(self.work_dir)
+
+	def tearDown(self):
+		rmtree(self.tmp_dir)
+
+	def write(self, name, data=b'png'):
+		with open(os.path.join(self.work_dir, name), 'wb') as handle:
+			handle.write(data)
+
+	def decode(self, names, poll):
+		uploader = OutputUploader(
+			self.work_dir,
+			LocalStorage('submissions', self.bucket_dir),
+			'submission',
+			interval=.05,
+			poll=poll,
+			manifest=os.path.join(self.work_dir, MANIFEST_NAME))
+		with uploader:
+			for name in names:
+				self.write(name)
+		mark(self.work_dir, DECODED_NAME)
+		return uploader
+
+	def test_decoded_outputs(self):
+		for poll in [False, True]:
+			with self.subTest(poll=poll):
+				self.decode(['a.png', 'b.png'], poll)
+
+				outputs = DecoderOutputs(self.work_dir, interval=.01, timeout=5.)
+				self.assertEqual(outputs.wait('a.png'), os.path.join(self.work_dir, 'a.png'))
+				self.assertEqual(outputs.wait('b.png'), os.path.join(self.work_dir, 'b.png'))
+				self.assertIsNone(outputs.wait('c.png'))
+				self.assertFalse(outputs.timed_out)
+
+				self.assertEqual(
+					sorted(os.listdir(os.path.join(self.bucket_dir, 'submission'))),
+					['a.png', 'b.png'])
+
+				rmtree(self.work_dir)
+				rmtree(self.bucket_dir)
+				os.makedirs(self.work_dir)
+
+	def test_submitted_outputs(self):
+		# images may be submitted instead of being created by a decoder
+		self.write('a.png')
+		uploader = self.decode([], poll=False)
+
+		outputs = DecoderOutputs(self.work_dir, interval=.01, timeout=5.)
+		self.assertEqual(outputs.wait('a.png'), os.path.join(self.work_dir, 'a.png'))
+
+		# submitted files are already stored in the bucket
+		self.assertEqual(uploader.uploaded, {})
+
+	def test_timeout(self):
+		outputs = DecoderOutputs(self.work_dir, interval=.01, timeout=.1)
+		self.assertIsNone(outputs.wait('a.png'))
+		self.assertTrue(outputs.timed_out)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -148,6 +148,12 @@ GS_BUCKET_SUBMISSIONS = os.environ.get('BUCKET_SUBMISSIONS')
 GS_MAX_MEMORY_SIZE = 10000000
 GS_BLOB_CHUNK_SIZE = 1048576
 
+# store buckets in local directories instead, e.g., to run the pipeline on a single machine
+STORAGE_ROOT = os.environ.get('STORAGE_ROOT')
+if STORAGE_ROOT:
+	DEFAULT_FILE_STORAGE = 'django.core.files.storage.FileSystemStorage'
+	MEDIA_ROOT = os.path.join(STORAGE_ROOT, GS_BUCKET_NAME or '')
+
 
 # Markdown
 # https://github.com/trentm/django-markdown-deux
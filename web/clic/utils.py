@@ -1,4 +1,12 @@
 import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from storages.backends.gcloud import GoogleCloudStorage
 
 
 def log_message(level, message, *args):
@@ -21,3 +29,69 @@ def log_message(level, message, *args):
 	formatter = logging.Formatter(
 		'[%(asctime)s] %(levelname)-8s %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 	return formatter.format(logging.LogRecord("", level, "", 0, message + '\r\n', args, None))
+
+
+def get_storage(bucket_name):
+	"""
+	Returns the storage of a bucket.
+
+	If `STORAGE_ROOT` is set, buckets are directories of the same name in `STORAGE_ROOT`, which is
+	also where `decode.py` and `evaluate.py` look for them, so that submissions can be processed
+	without access to Google Cloud Storage.
+
+	Parameters
+	----------
+	bucket_name : str
+		Name of the bucket
+
+	Returns
+	-------
+	django.core.files.storage.Storage
+	"""
+
+	if settings.STORAGE_ROOT:
+		return FileSystemStorage(location=os.path.join(settings.STORAGE_ROOT, bucket_name))
+	return GoogleCloudStorage(bucket_name=bucket_name)
+
+
+def save_files(bucket_name, files, num_threads=8):
+	"""
+	Saves multiple files at the same time.
+
+	Each thread uses its own storage, since clients of Google Cloud Storage are not thread-safe.
+
+	Parameters
+	----------
+	bucket_name : str
+		Name of the bucket to which files are saved
+
+	files : list[tuple]
+		Pairs of names and file objects
+
+	Returns
+	-------
+	list[str]
+		Names under which files were stored
+	"""
+
+	local = threading.local()
+
+	def save(file):
+		if not hasattr(local, 'storage'):
+			local.storage = get_storage(bucket_name)
+		return local.storage.save(name=file[0], content=file[1])
+
+	with ThreadPoolExecutor(min(num_threads, len(files)) or 1) as executor:
+		return list(executor.map(save, files))
+
+
+def delete_files(storage, path):
+	"""
+	Deletes all files stored under a path.
+	"""
+
+	if isinstance(storage, GoogleCloudStorage):
+		for blob in storage.bucket.list_blobs(prefix=path):
+			blob.delete()
+	else:
+		shutil.rmtree(storage.path(path), ignore_errors=True)
@@ -12,12 +12,12 @@ from django.http import StreamingHttpResponse, HttpResponse, Http404
 from django.shortcuts import render, redirect
 from django.template.loader import get_template
 from django.utils.crypto import get_random_string
-from storages.backends.gcloud import GoogleCloudStorage
 
 import teams
 import submissions.forms
 import submissions.models
 from .kubernetes_client import KubernetesClient
+from .utils import get_storage, save_files
 from . import models
 
 
@@ -103,28 +103,21 @@ def _decode(request, **kwargs):
 	submission.save()
 
 	# submission will be stored here
-	fs = GoogleCloudStorage(bucket_name=settings.GS_BUCKET_SUBMISSIONS)
 	fs_path = submission.fs_path()
 
-	# upload encoded image files to storage bucket
-	for file in request.FILES.getlist('data'):
-		fs.save(name=os.path.join(fs_path, file.name), content=file)
+	# upload encoded image files and decoder to storage bucket at the same time
+	files = [(os.path.join(fs_path, file.name), file) for file in request.FILES.getlist('data')]
 
 	if 'decoder' in request.FILES:
-		# upload decoder to storage bucket
 		if request.FILES['decoder'].name.lower().endswith('.zip'):
-			fs.save(
-				name=os.path.join(fs_path, 'decoder.zip'),
-				content=request.FILES['decoder'])
+			files.append((os.path.join(fs_path, 'decoder.zip'), request.FILES['decoder']))
 		else:
-			fs.save(
-				name=os.path.join(fs_path, 'decode'),
-				content=request.FILES['decoder'])
+			files.append((os.path.join(fs_path, 'decode'), request.FILES['decoder']))
 	else:
 		# no decoder provided, use dummy
-		fs.save(
-			name=os.path.join(fs_path, 'decode'),
-			content=ContentFile(b'#!/bin/bash'))
+		files.append((os.path.join(fs_path, 'decode'), ContentFile(b'#!/bin/bash')))
+
+	save_files(settings.GS_BUCKET_SUBMISSIONS, files)
 
 	# create job
 	job_template = get_template('job.yaml')
@@ -169,7 +162,7 @@ def reevaluate(request, pk):
 		raise Http404('Could not find submission.')
 
 	# submission is stored here
-	fs = GoogleCloudStorage(bucket_name=settings.GS_BUCKET_SUBMISSIONS)
+	fs = get_storage(settings.GS_BUCKET_SUBMISSIONS)
 	fs_path = submission.fs_path()
 
 	# create job
@@ -211,7 +204,7 @@ def logs(request, pk, container=['decode', 'evaluate']):
 
 	if len(pods) == 0:
 		# pods are gone, try to load logs stored with the submission
-		fs = GoogleCloudStorage(bucket_name=settings.GS_BUCKET_SUBMISSIONS)
+		fs = get_storage(settings.GS_BUCKET_SUBMISSIONS)
 		fs_path = submission.fs_path()
 
 		log_path_decode = os.path.join(fs_path, '.log_decode')
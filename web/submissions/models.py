@@ -1,3 +1,4 @@
+import json
 import os
 import re
 
@@ -6,10 +7,11 @@ from django.db import models
 from django.db.models.signals import post_delete
 from django.dispatch import receiver
 from django.utils import timezone
-from storages.backends.gcloud import GoogleCloudStorage
 
 from jsonfield import JSONField
 
+from clic.utils import delete_files, get_storage
+
 
 class Task(models.Model):
 	name = models.CharField(primary_key=True, max_length=32)
@@ -57,6 +59,18 @@ class Phase(models.Model):
 	def __str__(self):
 		return '{0} ({1})'.format(self.task, self.description.lower())
 
+	def pipelined(self):
+		"""
+		Whether submissions are evaluated while they are being decoded
+		"""
+		settings = self.settings
+		if isinstance(settings, str):
+			try:
+				settings = json.loads(settings) if settings else {}
+			except ValueError:
+				settings = {}
+		return bool(settings.get('pipelined', False))
+
 
 class DockerImage(models.Model):
 	name = models.CharField(max_length=256)
@@ -158,10 +172,8 @@ class Submission(models.Model):
 @receiver(post_delete, sender=Submission, dispatch_uid='delete_submission')
 def delete_submission(sender, instance, **kwargs):
 	# delete files corresponding to submission
-	fs = GoogleCloudStorage(bucket_name=settings.GS_BUCKET_SUBMISSIONS)
-	blobs = fs.bucket.list_blobs(prefix=instance.fs_path())
-	for blob in blobs:
-		blob.delete()
+	fs = get_storage(settings.GS_BUCKET_SUBMISSIONS)
+	delete_files(fs, instance.fs_path())
 
 
 class Measurement(models.Model):